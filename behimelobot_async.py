@@ -0,0 +1,463 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import aiohttp
+from aiohttp import web
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+import behimelobot_render as core
+import behimelobot_notify
+import behimelobot_prefetch
+
+# asyncio serving mode: same routes and command handlers as the Flask app, but upstream and
+# Telegram I/O never blocks a thread, so one process can hold thousands of updates in flight.
+#   python behimelobot_async.py
+#   gunicorn 'behimelobot_async:create_app()' --worker-class aiohttp.GunicornWebWorker
+
+class AsyncUpstream:
+    def __init__(self):
+        self.session = None
+        self._flights = {}
+        self.stats = {'new_connections': 0, 'pool_hits': 0, 'coalesced': 0, 'originating': 0}
+
+    async def start(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_new_connection)
+        trace.on_connection_reuseconn.append(self._on_reused_connection)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=core.config.API_POOL_SIZE, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(connect=core.config.API_CONNECT_TIMEOUT, sock_read=core.config.API_READ_TIMEOUT),
+            trace_configs=[trace],
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def _on_new_connection(self, session, context, params):
+        self.stats['new_connections'] += 1
+
+    async def _on_reused_connection(self, session, context, params):
+        self.stats['pool_hits'] += 1
+
+    async def fetch(self, action, params=None):
+        breaker = core.get_api_breaker()
+        ticket = breaker.allow()
+        if ticket is None:
+            core.metric_child(core.UPSTREAM_ERRORS, action, 'rejected').inc()
+            return False, core.UPSTREAM_UNAVAILABLE
+        in_flight = core.metric_child(core.IN_FLIGHT, 'upstream')
+        in_flight.inc()
+        started = time.monotonic()
+        try:
+            success, data = await self._post(action, params)
+        except asyncio.CancelledError:
+            breaker.release(ticket)
+            raise
+        finally:
+            in_flight.dec()
+        latency = time.monotonic() - started
+        breaker.record(ticket, success, latency)
+        core.record_upstream(action, latency, success)
+        return success, data
+
+    async def _post(self, action, params=None):
+        try:
+            if not core.config.ACCESS_KEY:
+                logging.error("ACCESS_KEY is not set")
+                return False, "ACCESS_KEY تنظیم نشده"
+            post_data = {'accessKey': core.config.ACCESS_KEY, 'action': action}
+            if params:
+                post_data.update(params)
+            core._count_api_stat('calls')
+            attempts = 1 + (core.config.API_MAX_RETRIES if action in core.IDEMPOTENT_ACTIONS else 0)
+            for attempt in range(attempts):
+                if attempt:
+                    core._count_api_stat('retries')
+                    await asyncio.sleep(core.config.API_RETRY_BACKOFF * (2 ** (attempt - 1)))
+                    logging.warning(f"Retrying API call: action={action}, attempt={attempt + 1}/{attempts}")
+                try:
+                    async with self.session.post(core.config.API_BASE, data=post_data) as response:
+                        status = response.status
+                        body = await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt + 1 < attempts:
+                        logging.warning(f"API call {action} failed: {e!r}")
+                        continue
+                    raise
+                if status in core.RETRY_STATUS_CODES and attempt + 1 < attempts:
+                    continue
+                break
+            logging.info("API call: action=%s, params=%s, status=%s, size=%d", action, params, status, len(body), extra=core.SAMPLED)
+            if status != 200:
+                logging.error(f"API request failed with status {status}")
+                core._count_api_stat('errors')
+                return False, f"HTTP {status}"
+            try:
+                data = json.loads(body)
+            except ValueError as e:
+                logging.error(f"JSON parsing error: {e}")
+                return False, "Invalid JSON response"
+            if not isinstance(data, dict):
+                return False, "Invalid JSON response: not a dictionary"
+            return True, data
+        except Exception as e:
+            logging.error(f"API call error: {e!r}")
+            core._count_api_stat('errors')
+            return False, str(e) or repr(e)
+
+    async def _store(self, key, action, result, ttl=None):
+        # The shared store is SQLite or Redis, so it is written from a thread, off the loop
+        if core.store_api_response(key, action, *result, ttl, shared=False) and action in core.SHARED_ACTIONS:
+            await asyncio.to_thread(core.store_shared_response, key, action, result[1], core.cache_ttl_for(action, ttl))
+
+    async def _fetch_and_store(self, key, action, params, ttl=None):
+        if action not in core.COALESCED_ACTIONS:
+            result = await self.fetch(action, params)
+            await self._store(key, action, result, ttl)
+            return result
+        future = self._flights.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future)
+        self.stats['originating'] += 1
+        future = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self.fetch(action, params)
+            await self._store(key, action, result, ttl)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark it retrieved so a flight without waiters does not log "never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._flights[key]
+
+    async def _refresh(self, key, action, params, ttl=None):
+        success = False
+        try:
+            success, data = await self._fetch_and_store(key, action, params, ttl)
+        finally:
+            core.release_refresh(key, success)
+
+    async def call(self, action, params=None, ttl=None):
+        key = core.api_cache_key(action, params)
+        data, fresh = core.lookup_api_cache(key, action, ttl, shared=False)
+        if data is None and action in core.SHARED_ACTIONS and core.cache_ttl_for(action, ttl):
+            data, fresh = await asyncio.to_thread(core.load_shared_response, key)
+        if data is not None:
+            if not fresh and core.claim_refresh(key):
+                asyncio.create_task(self._refresh(key, action, params, ttl))
+            return True, data
+        return core.degrade(key, await self._fetch_and_store(key, action, params, ttl))
+
+
+async def send_message(bot, chat_id, text, reply_markup=None):
+    try:
+        with core.telegram_call('send_message'):
+            await bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=reply_markup)
+        logging.info("Sent message to chat %s: %.50s...", chat_id, text, extra=core.SAMPLED)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to send Telegram message: {e}")
+        return False
+
+
+async def acquire_bucket(bucket):
+    while True:
+        wait = bucket.reserve()
+        if wait == 0.0:
+            return
+        await asyncio.sleep(wait)
+
+
+async def send_audio(bot, chat_id, audio_url, caption=''):
+    chat_bucket = core.get_chat_bucket(chat_id)
+    file_ids = core.get_file_id_cache()
+    file_id = await asyncio.to_thread(file_ids.get, audio_url)
+    retries = 0
+    while True:
+        await acquire_bucket(chat_bucket)
+        await acquire_bucket(core.get_global_bucket())
+        started = time.monotonic()
+        try:
+            with core.telegram_call('send_audio'):
+                message = await bot.send_audio(chat_id, file_id or audio_url, caption=caption)
+            latency = time.monotonic() - started
+            core._count_audio_stat('sent', latency)
+            if file_id is None and getattr(message, 'audio', None) is not None:
+                await asyncio.to_thread(file_ids.set, audio_url, message.audio.file_id)
+            logging.info("Sent audio to chat %s in %.2fs (%s): %s", chat_id, latency, 'cached' if file_id else 'upload', caption, extra=core.SAMPLED)
+            return True
+        except Exception as e:
+            if file_id is not None and core.is_bad_file_id(e):
+                logging.warning(f"Cached file_id rejected for {audio_url}, re-sending by URL")
+                await asyncio.to_thread(file_ids.invalidate, audio_url)
+                file_id = None
+                continue
+            retry_after = core.retry_after_seconds(e)
+            if retry_after is None or retries == core.config.AUDIO_SEND_RETRIES:
+                logging.error(f"Failed to send audio to chat {chat_id}: {e}")
+                break
+            retries += 1
+            core._count_audio_stat('throttled')
+            logging.warning(f"Telegram flood limit for chat {chat_id}, retrying after {retry_after}s")
+            chat_bucket.pause(retry_after)
+    core._count_audio_stat('failed')
+    return False
+
+
+async def _perform_send(app, effect):
+    return await send_message(app['bot'], effect.chat_id, effect.text, effect.reply_markup)
+
+
+async def _perform_edit(app, effect):
+    try:
+        with core.telegram_call('edit_message_text'):
+            await app['bot'].edit_message_text(effect.text, effect.chat_id, effect.message_id, parse_mode='HTML',
+                                               reply_markup=effect.reply_markup)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to edit message {effect.message_id} in chat {effect.chat_id}: {e}")
+        return False
+
+
+async def _perform_api_call(app, effect):
+    return await app['upstream'].call(effect.action, effect.params, effect.ttl)
+
+
+async def _perform_send_audios(app, effect):
+    results = await asyncio.gather(*(send_audio(app['bot'], effect.chat_id, t.audio_url, t.title) for t in effect.tracks))
+    return sum(1 for sent in results if sent)
+
+
+async def _perform_answer_callback(app, effect):
+    try:
+        with core.telegram_call('answer_callback_query'):
+            await app['bot'].answer_callback_query(effect.callback_query_id, text=effect.text)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to answer callback query: {e}")
+        return False
+
+async def _perform_answer_inline(app, effect):
+    try:
+        file_ids = core.get_file_id_cache()
+        results = await asyncio.to_thread(core.build_inline_results, effect.tracks, file_ids.get)
+        with core.telegram_call('answer_inline_query'):
+            await app['bot'].answer_inline_query(effect.inline_query_id, results, cache_time=effect.cache_time)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to answer inline query: {e}")
+        return False
+
+
+async def _perform_subscription_op(app, effect):
+    return await asyncio.to_thread(core._perform_subscription_op, effect)
+
+
+async def _perform_cached_feed(app, effect):
+    return await asyncio.to_thread(core._perform_cached_feed, effect)
+
+EFFECT_PERFORMERS = {
+    core.SendMessage: _perform_send,
+    core.EditMessage: _perform_edit,
+    core.ApiCall: _perform_api_call,
+    core.SendAudios: _perform_send_audios,
+    core.AnswerCallback: _perform_answer_callback,
+    core.AnswerInline: _perform_answer_inline,
+    core.SubscriptionOp: _perform_subscription_op,
+    core.CachedFeed: _perform_cached_feed,
+}
+
+
+async def dispatch_update(app, update):
+    command, ctx = core.route_update(update)
+    if command is None:
+        return
+    in_flight = core.metric_child(core.IN_FLIGHT, 'updates')
+    in_flight.inc()
+    started = time.monotonic()
+    failed = True
+    try:
+        with core.log_context(update_id=update.get('update_id'), command=command.name, chat_id=core.update_chat_key(update)):
+            steps = command.handler(command, ctx)
+            result = None
+            while True:
+                try:
+                    effect = steps.send(result)
+                except StopIteration:
+                    break
+                result = await EFFECT_PERFORMERS[type(effect)](app, effect)
+        failed = False
+    finally:
+        in_flight.dec()
+        core.record_command(command.name, time.monotonic() - started, failed)
+
+
+async def _run_update(app, update, enqueued_at, delay=0.0):
+    try:
+        if delay:
+            await asyncio.sleep(delay)
+        await dispatch_update(app, update)
+        core._count_webhook_stat('processed')
+    except Exception as e:
+        logging.error(f"Update {update.get('update_id')} processing error: {e}")
+        core._count_webhook_stat('failed')
+    finally:
+        app['update_slots'].leave()
+        latency = time.monotonic() - enqueued_at
+        with core._webhook_stats_lock:
+            core.webhook_stats['latency_total'] += latency
+            core.webhook_stats['latency_max'] = max(core.webhook_stats['latency_max'], latency)
+
+
+async def webhook(request):
+    try:
+        update = await request.json()
+    except ValueError:
+        update = None
+    if not isinstance(update, dict):
+        return web.json_response({'error': 'Invalid update'}, status=400)
+    core._count_webhook_stat('received')
+    update_id = update.get('update_id')
+    if core._is_duplicate_update(update_id, shared=False) or (update_id is not None and not await asyncio.to_thread(core.claim_update, update_id)):
+        core._count_webhook_stat('duplicates')
+        return web.json_response({'status': 'duplicate'})
+    app = request.app
+    admitted, reply = core.admit_update(update, app['update_slots'])
+    if not admitted:
+        core._count_webhook_stat('rejected')
+        return web.json_response(core.webhook_reply(reply) if reply else {'status': 'rejected'})
+    task = asyncio.create_task(_run_update(app, update, time.monotonic(), core.inline_debounce(update)))
+    app['tasks'].add(task)
+    task.add_done_callback(app['tasks'].discard)
+    return web.json_response({'status': 'ok'})
+
+
+def asset_response(request, asset, max_age):
+    status, headers, body = asset.respond(request.headers.get('If-None-Match'), request.headers.get('Accept-Encoding'), max_age)
+    return web.Response(body=body, status=status, headers=headers)
+
+
+async def api_search(request):
+    refused = core.admit_api_search(core.client_ip(request.remote, request.headers.get('X-Forwarded-For')))
+    if refused:
+        status, error, retry_after = refused
+        return web.json_response({'error': error}, status=status, headers={'Retry-After': str(retry_after)})
+    try:
+        if request.method == 'GET':
+            query = request.query.get('query', '').strip()
+        else:
+            data = await request.json()
+            query = data.get('query', '').strip()
+        if not query:
+            return web.json_response({'error': 'Query is required'}, status=400)
+        query = core.normalize_query(query)
+        success, api_data = await request.app['upstream'].call('search', {'query': query})
+        if not success:
+            logging.error(f"Search failed for query {query}: {api_data}")
+            return web.json_response({'error': f'Search failed: {api_data}'}, status=500)
+        core.remember_search(query, api_data)
+        return asset_response(request, core.search_api_asset(query, api_data), core.config.API_SEARCH_MAX_AGE)
+    except Exception as e:
+        logging.error(f"API search error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+    finally:
+        core.get_api_search_slots().leave()
+
+
+def health_payload(app):
+    payload = core.health_payload()
+    payload['mode'] = 'asyncio'
+    payload['upstream_pool'].update(app['upstream'].stats)
+    payload['webhook']['in_flight'] = app['update_slots'].active
+    payload['webhook']['queue_size'] = core.config.ASYNC_MAX_UPDATES
+    payload['admission']['pending_updates'] = app['update_slots'].active
+    payload['admission']['max_pending_updates'] = core.config.ASYNC_MAX_UPDATES
+    return payload
+
+
+async def health(request):
+    return web.json_response(health_payload(request.app))
+
+
+async def metrics(request):
+    core.export_stats(health_payload(request.app))
+    return web.Response(body=core.metrics_body(), headers={'Content-Type': core.CONTENT_TYPE_LATEST})
+
+
+@web.middleware
+async def request_metrics(request, handler):
+    in_flight = core.metric_child(core.IN_FLIGHT, 'http')
+    in_flight.inc()
+    started = time.monotonic()
+    status = 500
+    try:
+        with core.log_context(request_id=request.headers.get('X-Request-ID') or os.urandom(6).hex()):
+            response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        in_flight.dec()
+        route = request.match_info.route.resource
+        route = route.canonical if route is not None else 'unmatched'
+        core.metric_child(core.HTTP_LATENCY, route).observe(time.monotonic() - started)
+        core.metric_child(core.HTTP_REQUESTS, route, str(status)).inc()
+
+
+async def index(request):
+    return asset_response(request, core.get_webapp_asset(), core.config.WEBAPP_MAX_AGE)
+
+
+async def _on_startup(app):
+    app['upstream'] = AsyncUpstream()
+    await app['upstream'].start()
+    if core.config.TELEGRAM_API_URL:
+        asyncio_helper.API_URL = core.telegram_api_url_template()
+    app['bot'] = AsyncTeleBot(core.config.TELEGRAM_TOKEN)
+    if core.config.NOTIFY_ENABLED:
+        behimelobot_notify.start_in_background()
+    if core.config.PREFETCH_ENABLED:
+        behimelobot_prefetch.start_in_background()
+
+
+async def _on_cleanup(app):
+    if app['tasks']:
+        await asyncio.gather(*app['tasks'], return_exceptions=True)
+    await app['upstream'].close()
+    try:
+        await app['bot'].close_session()
+    except AttributeError:
+        # telebot has no session to close if the bot never made a request
+        pass
+
+
+def create_app():
+    core.warm_up()
+    app = web.Application(middlewares=[request_metrics])
+    app['update_slots'] = core.ConcurrencyLimit(core.config.ASYNC_MAX_UPDATES)
+    app['tasks'] = set()
+    app.router.add_post('/webhook', webhook)
+    app.router.add_post('/api/search', api_search)
+    app.router.add_get('/api/search', api_search)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/webapp', index)
+    app.router.add_get('/', index)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=core.config.PORT)
@@ -0,0 +1,553 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Load-test harness: starts local stand-ins for the rj.php API and the Telegram Bot API, launches the
+# bot against them and replays webhook updates and /api/search requests. Everything is seeded and
+# the report records the commit, so two runs can be compared:
+#   python behimelobot_bench.py --server gunicorn --workers 2 --requests 2000 --output after.json
+#   python behimelobot_bench.py --compare before.json after.json
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ARTISTS = ['شادمهر عقیلی', 'ابی', 'گوگوش', 'محسن یگانه', 'هایده', 'معین', 'سیروان خسروی', 'رضا صادقی', 'Shadmehr', 'Ebi']
+DEFAULT_MIX = 'search=60,new_tracks=10,trending_tracks=10,random_track=5,top_artists=5,special_playlist=5,inline=5'
+# Message text that routes each synthetic update to its command; search and inline use a query
+COMMAND_TEXTS = {
+    'start': '/start',
+    'new_tracks': '🎵 آهنگ جدید',
+    'trending_tracks': '/trending',
+    'random_track': '/random',
+    'top_artists': '/artists',
+    'special_playlist': '/playlist',
+}
+
+
+def music_items(prefix, count):
+    musics = {}
+    for i in range(count):
+        artist = ARTISTS[i % len(ARTISTS)]
+        track_id = f'{prefix}{i}'
+        musics[track_id] = {
+            'id': track_id,
+            'title': f'{artist} - آهنگ {i}',
+            'artist_name': {'fa': artist, 'en': f'Artist {i % len(ARTISTS)}'},
+            'song_name': {'fa': f'آهنگ {i}', 'en': f'Song {i}'},
+            'audio_url': f'https://host.example/media/{track_id}.mp3',
+            'share_link': f'https://host.example/song/{track_id}',
+            'photo': f'https://host.example/photo/{track_id}.jpg',
+            'plays': 1000 + i,
+            'likes': 100 + i,
+        }
+    return musics
+
+
+def upstream_payload(action, params, tracks, serial):
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:8]
+    if action == 'top_artists':
+        return {'ok': True, 'result': {'artists': [{'name': name} for name in ARTISTS]}}
+    if action == 'special_playlist':
+        return {'ok': True, 'result': {'playlist': [{'title': f'پلی‌لیست {i}'} for i in range(tracks)]}}
+    if action == 'random_track':
+        return {'ok': True, 'result': {'search_result': {'musics': music_items(f'r{serial}-', 1), 'videos': {}}}}
+    return {'ok': True, 'result': {'search_result': {'musics': music_items(f'{action[0]}{key}-', tracks), 'videos': {}}}}
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, jitter, tracks, error_rate, seed):
+        super().__init__(('127.0.0.1', 0), FakeUpstreamHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.tracks = tracks
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        action = form.pop('action', '')
+        form.pop('accessKey', None)
+        with server.lock:
+            server.calls[action] += 1
+            serial = sum(server.calls.values())
+            failed = server.random.random() < server.error_rate
+            delay = max(server.latency + server.random.uniform(-server.jitter, server.jitter), 0)
+        time.sleep(delay)
+        if failed:
+            self.send_response(502)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps(upstream_payload(action, form, server.tracks, serial), ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(('127.0.0.1', 0), FakeTelegramHandler)
+        self.latency = latency
+        self.calls = Counter()
+        self.last_call = {}  # chat_id / inline_query_id -> monotonic time of its latest call
+        self.lock = threading.Lock()
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if 'json' in content_type:
+            params.update(json.loads(body or b'{}'))
+        elif 'urlencoded' in content_type:
+            params.update(urllib.parse.parse_qsl(body.decode()))
+        return url.path.rsplit('/', 1)[-1], params
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        server = self.server
+        method, params = self._params()
+        time.sleep(server.latency)
+        result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'}}
+        if method == 'sendAudio':
+            audio = str(params.get('audio', ''))
+            result['audio'] = {'file_id': 'F' + hashlib.sha1(audio.encode()).hexdigest(), 'file_unique_id': audio[-16:], 'duration': 180}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method != 'sendMessage':
+            result = True
+        key = params.get('chat_id') or params.get('inline_query_id')
+        with server.lock:
+            server.calls[method] += 1
+            if key is not None:
+                server.last_call[str(key)] = time.monotonic()
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_in_background(server):
+    threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_bot_server(args, upstream, telegram, workdir):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_TOKEN': '123456:bench',
+        'ACCESS_KEY': 'bench',
+        'API_BASE': f'http://127.0.0.1:{upstream.server_port}/rj.php',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{telegram.server_port}',
+        'PORT': str(port),
+        # Measure the bot, not Telegram's flood limits or our per-IP limit (every request comes from
+        # 127.0.0.1); pass --env to benchmark those too
+        'TELEGRAM_GLOBAL_RATE': '1000000',
+        'TELEGRAM_CHAT_RATE': '1000000',
+        'TELEGRAM_CHAT_BURST': '1000000',
+        'API_SEARCH_RATE_LIMIT': '0',
+        # Every store in the run's own directory, so one run cannot warm the next (or a real bot on this host)
+        'FILE_ID_DB_PATH': os.path.join(workdir, 'file_ids.db'),
+        'SEARCH_INDEX_PATH': os.path.join(workdir, 'search_index.json'),
+        'SHARED_CACHE_URL': 'sqlite://' + os.path.join(workdir, 'shared_cache.db'),
+        'SUBSCRIPTIONS_DB_PATH': os.path.join(workdir, 'subscriptions.db'),
+        'NOTIFY_DB_PATH': os.path.join(workdir, 'notify.db'),
+        'NOTIFY_LOCK_PATH': os.path.join(workdir, 'notify.lock'),
+        'POLLING_DB_PATH': os.path.join(workdir, 'polling.db'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, 'metrics'),
+    })
+    env.update(pair.split('=', 1) for pair in args.env)
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', 'behimelobot_render:create_app()', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(args.workers), '--threads', str(args.threads)]
+    elif args.server == 'async':
+        command = [sys.executable, 'behimelobot_async.py']
+    else:
+        command = [sys.executable, 'behimelobot_render.py']
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    started = time.monotonic()
+    process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = started + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Bot server exited with {process.returncode}, see {log.name}")
+        try:
+            health = get_json(base_url + '/health')
+            startup = {'seconds_to_healthy': round(time.monotonic() - started, 3), 'server': health.get('startup')}
+            return process, base_url, startup
+        except OSError:
+            time.sleep(0.02)
+    process.kill()
+    raise RuntimeError(f"Bot server did not become healthy in {args.startup_timeout}s, see {log.name}")
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def request(url, data=None):
+    # Returns (status, seconds, body); HTTP errors are results, not exceptions
+    body = None if data is None else json.dumps(data).encode()
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'})
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            content = response.read()
+            status = response.status
+            if response.headers.get('Content-Encoding') == 'gzip':
+                content = gzip.decompress(content)
+    except urllib.error.HTTPError as e:
+        status, content = e.code, b''
+    except OSError:
+        status, content = 0, b''
+    return status, time.monotonic() - started, content
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in COMMAND_TEXTS and name not in ('search', 'inline'):
+            raise SystemExit(f"Unknown command in --mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+class QueryPool:
+    # Zipf-like popularity, so --distinct-queries controls how often a query repeats
+    def __init__(self, distinct, rng):
+        self.queries = [f'{ARTISTS[i % len(ARTISTS)]} {i}' for i in range(distinct)]
+        self.weights = [1 / (i + 1) for i in range(distinct)]
+        self.rng = rng
+
+    def pick(self):
+        return self.rng.choices(self.queries, self.weights)[0]
+
+
+def synthetic_updates(count, mix, queries, rng):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    for _ in range(count):
+        name = rng.choices(names, weights)[0]
+        if name == 'inline':
+            yield {'inline_query': {'id': '0', 'from': {'id': 1, 'is_bot': False, 'first_name': 'b'}, 'query': queries.pick(), 'offset': ''}}
+        else:
+            text = queries.pick() if name == 'search' else COMMAND_TEXTS[name]
+            yield {'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 0, 'type': 'private'},
+                               'from': {'id': 0, 'is_bot': False, 'first_name': 'b'}, 'text': text}}
+
+
+def recorded_updates(path, count):
+    with open(path, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    if not updates:
+        raise SystemExit(f"No updates in {path}")
+    for i in range(count):
+        yield json.loads(json.dumps(updates[i % len(updates)]))
+
+
+def tag_update(update, serial):
+    # Unique update and chat ids keep dedup and per-chat rate limits out of the measurement, and
+    # let the fake Telegram API tell which update its calls belong to
+    update['update_id'] = serial
+    chat_id = 10 ** 9 + serial
+    if 'inline_query' in update:
+        update['inline_query']['id'] = str(chat_id)
+        update['inline_query']['from']['id'] = chat_id
+        return str(chat_id)
+    message = update.get('message') or (update.get('callback_query') or {}).get('message')
+    if message is None:
+        return None
+    message['chat']['id'] = chat_id
+    if 'callback_query' in update:
+        update['callback_query']['from']['id'] = chat_id
+    elif 'from' in message:
+        message['from']['id'] = chat_id
+    return str(chat_id)
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def rank(p):
+        return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 2)
+
+    return {'count': len(samples), 'mean_ms': round(sum(samples) / len(samples) * 1000, 2),
+            'p50_ms': rank(0.50), 'p95_ms': rank(0.95), 'p99_ms': rank(0.99), 'max_ms': round(samples[-1] * 1000, 2)}
+
+
+# Seconds without any Telegram call after which a drained run counts as finished; audio sends trail
+# their update and may be paced by the per-chat limit
+DRAIN_QUIET = 1.5
+
+
+def is_shed(body):
+    # Admission control answers a refused update with 200 and the refusal (a Bot API call Telegram
+    # performs itself) or {'status': 'rejected'} in the body
+    try:
+        reply = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(reply, dict) and ('method' in reply or reply.get('status') == 'rejected')
+
+
+def replay_webhook(base_url, updates, concurrency, telegram, upstream, drain_timeout):
+    # Completion is read off the fake Telegram API, which sees every worker's calls; /health would
+    # only describe the one gunicorn worker that answered it
+    before_upstream = sum(upstream.calls.values())
+    before_telegram = sum(telegram.calls.values())
+    sent = {}
+    acks = []
+    statuses = Counter()
+    rejected = []
+    lock = threading.Lock()
+
+    def post(item):
+        key, update = item
+        started = time.monotonic()
+        status, latency, body = request(base_url + '/webhook', update)
+        with lock:
+            acks.append(latency)
+            statuses[status] += 1
+            if status == 200 and is_shed(body):
+                rejected.append(key)
+            elif status == 200 and key is not None:
+                sent[key] = started
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(post, updates))
+    deadline = time.monotonic() + drain_timeout
+    while time.monotonic() < deadline:
+        with telegram.lock:
+            waiting = any(key not in telegram.last_call for key in sent)
+            latest = max(telegram.last_call.values(), default=0.0)
+        if not waiting and time.monotonic() - latest >= DRAIN_QUIET:
+            break
+        time.sleep(0.05)
+    with telegram.lock:
+        finished = {key: telegram.last_call[key] for key in sent if key in telegram.last_call}
+    latencies = [finished[key] - sent[key] for key in finished]
+    elapsed = (max(finished.values()) if finished else time.monotonic()) - started
+    count = len(acks)
+    return {
+        'updates': count,
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'rejected': len(rejected),
+        'unanswered': len(sent) - len(finished),
+        'updates_per_second': round(len(finished) / elapsed, 2) if elapsed > 0 else 0.0,
+        'ack': percentiles(acks),
+        'end_to_end': percentiles(latencies),
+        'upstream_calls_per_update': round((sum(upstream.calls.values()) - before_upstream) / count, 3) if count else 0.0,
+        'telegram_calls_per_update': round((sum(telegram.calls.values()) - before_telegram) / count, 3) if count else 0.0,
+    }
+
+
+def replay_search(base_url, queries, count, concurrency, upstream):
+    before_upstream = sum(upstream.calls.values())
+    urls = [base_url + '/api/search?' + urllib.parse.urlencode({'query': queries.pick()}) for _ in range(count)]
+    started = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(request, urls))
+    elapsed = time.monotonic() - started
+    statuses = Counter(status for status, _, _ in results)
+    return {
+        'requests': count,
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'requests_per_second': round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency': percentiles([latency for _, latency, _ in results]),
+        'upstream_calls_per_request': round((sum(upstream.calls.values()) - before_upstream) / count, 3) if count else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    queries = QueryPool(args.distinct_queries, rng)
+    upstream = serve_in_background(FakeUpstream(args.upstream_latency / 1000, args.upstream_jitter / 1000, args.tracks, args.error_rate, args.seed))
+    telegram = serve_in_background(FakeTelegram(args.telegram_latency / 1000))
+    with tempfile.TemporaryDirectory(prefix='behimelobot-bench-') as workdir:
+        process, base_url, startup = start_bot_server(args, upstream, telegram, workdir)
+        try:
+            def stream(count, offset):
+                if args.updates:
+                    source = recorded_updates(args.updates, count)
+                else:
+                    source = synthetic_updates(count, parse_mix(args.mix), queries, rng)
+                return [(tag_update(update, offset + i), update) for i, update in enumerate(source)]
+
+            if args.warmup:
+                replay_webhook(base_url, stream(args.warmup, 1), args.concurrency, telegram, upstream, args.drain_timeout)
+            report = {
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+                'config': {name: value for name, value in vars(args).items() if name not in ('compare', 'output')},
+                'startup': startup,
+                'webhook': replay_webhook(base_url, stream(args.requests, args.warmup + 1), args.concurrency, telegram, upstream, args.drain_timeout),
+            }
+            if args.search_requests:
+                report['api_search'] = replay_search(base_url, queries, args.search_requests, args.concurrency, upstream)
+            report['upstream_calls'] = dict(upstream.calls)
+            report['telegram_calls'] = dict(telegram.calls)
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    report['commit'], report['dirty'] = git_revision()
+    return report
+
+
+# (section, metric, higher is better)
+COMPARED_METRICS = [
+    ('startup', 'seconds_to_healthy', False),
+    ('webhook', 'updates_per_second', True),
+    ('webhook', 'rejected', False),
+    ('webhook.end_to_end', 'p50_ms', False),
+    ('webhook.end_to_end', 'p95_ms', False),
+    ('webhook.end_to_end', 'p99_ms', False),
+    ('webhook.ack', 'p99_ms', False),
+    ('webhook', 'upstream_calls_per_update', False),
+    ('webhook', 'telegram_calls_per_update', False),
+    ('api_search', 'requests_per_second', True),
+    ('api_search.latency', 'p50_ms', False),
+    ('api_search.latency', 'p95_ms', False),
+    ('api_search.latency', 'p99_ms', False),
+    ('api_search', 'upstream_calls_per_request', False),
+]
+
+
+def lookup(report, section, metric):
+    value = report
+    for part in section.split('.') + [metric]:
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"base {str(base.get('commit'))[:10]}{' (dirty)' if base.get('dirty') else ''}  vs  new {str(new.get('commit'))[:10]}{' (dirty)' if new.get('dirty') else ''}")
+    changed = sorted(name for name in set(base['config']) | set(new['config']) if base['config'].get(name) != new['config'].get(name))
+    if changed:
+        print(f"warning: runs used different settings: {', '.join(changed)}")
+    for section, metric, higher_is_better in COMPARED_METRICS:
+        old, cur = lookup(base, section, metric), lookup(new, section, metric)
+        if old is None or cur is None:
+            continue
+        delta = (cur - old) / old * 100 if old else 0.0
+        better = delta > 0 if higher_is_better else delta < 0
+        print(f"{section + '.' + metric:<45} {old:>10} {cur:>10} {delta:>+8.1f}% {'better' if better and delta else ''}")
+
+
+def summarize(report):
+    print(f"startup: healthy after {report['startup']['seconds_to_healthy']}s")
+    webhook = report['webhook']
+    print(f"webhook: {webhook['updates']} updates, {webhook['updates_per_second']} updates/s, statuses {webhook['statuses']}, rejected {webhook.get('rejected', 0)}, unanswered {webhook['unanswered']}")
+    print(f"  end-to-end {webhook['end_to_end']}")
+    print(f"  ack        {webhook['ack']}")
+    print(f"  upstream calls/update {webhook['upstream_calls_per_update']}, telegram calls/update {webhook['telegram_calls_per_update']}")
+    search = report.get('api_search')
+    if search:
+        print(f"/api/search: {search['requests']} requests, {search['requests_per_second']} req/s, statuses {search['statuses']}")
+        print(f"  latency {search['latency']}, upstream calls/request {search['upstream_calls_per_request']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local fake upstream and Telegram APIs")
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'async'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1, help="gunicorn workers")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument('--requests', type=int, default=1000, help="webhook updates to replay")
+    parser.add_argument('--warmup', type=int, default=100, help="updates replayed before measuring")
+    parser.add_argument('--search-requests', type=int, default=1000, help="/api/search requests, 0 to skip")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--updates', help="JSON-lines file of recorded Telegram updates (default: synthetic)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="synthetic command weights")
+    parser.add_argument('--distinct-queries', type=int, default=200)
+    parser.add_argument('--tracks', type=int, default=20, help="tracks per upstream response")
+    parser.add_argument('--upstream-latency', type=float, default=80, help="milliseconds")
+    parser.add_argument('--upstream-jitter', type=float, default=40, help="milliseconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of upstream calls answered with 502")
+    parser.add_argument('--telegram-latency', type=float, default=30, help="milliseconds")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="extra environment for the bot server")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--output', help="write the JSON report here")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help="compare two JSON reports and exit")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args)
+    summarize(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
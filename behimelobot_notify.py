@@ -0,0 +1,215 @@
+import fcntl
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter
+import behimelobot_render as core
+
+# New-release notifications: one job polls upstream new_tracks, diffs it against the tracks it has
+# already seen and queues one notification per matching subscriber in an SQLite outbox, in the same
+# transaction that marks the tracks seen. A sender drains the outbox in batches at NOTIFY_RATE
+# messages/s, reusing cached audio file_ids, so a crash resumes where it stopped instead of losing or
+# repeating a whole release. A lock file keeps it to one notifier per host.
+#   python behimelobot_notify.py
+#   NOTIFY_ENABLED=1 gunicorn ...   (gunicorn.conf.py starts it in one worker)
+
+NOTIFICATIONS = Counter('behimelobot_notifications_total', 'Release notifications by outcome: sent, retried, dropped', ['result'])
+SEEN_RETENTION = 7 * 86400  # forget tracks that left new_tracks a week ago
+
+
+def release_artist_keys(data):
+    # music id -> match keys of the artist's names in every language upstream gives, so a subscription
+    # typed in Persian or English, by full name or by some of its words, matches
+    search_result = data.get('result', {}).get('search_result', {}) if isinstance(data, dict) else {}
+    musics = search_result.get('musics') if isinstance(search_result, dict) else None
+    keys = {}
+    for music_id, music_data in (musics.items() if isinstance(musics, dict) else ()):
+        names = music_data.get('artist_name') if isinstance(music_data, dict) else None
+        names = names.values() if isinstance(names, dict) else [names]
+        keys[music_id] = {key for name in names if name for key in core.artist_match_keys(str(name))}
+    return keys
+
+
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS seen_tracks (track_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, '
+                         'track_id TEXT NOT NULL, audio_url TEXT NOT NULL, caption TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                         'next_attempt REAL NOT NULL DEFAULT 0, UNIQUE (chat_id, track_id))')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def has_snapshot(self):
+        with self._lock:
+            return self._connection().execute('SELECT 1 FROM seen_tracks LIMIT 1').fetchone() is not None
+
+    def unseen(self, track_ids):
+        with self._lock:
+            conn = self._connection()
+            return [t for t in track_ids if conn.execute('SELECT 1 FROM seen_tracks WHERE track_id = ?', (t,)).fetchone() is None]
+
+    def record_release(self, track_ids, notifications):
+        # notifications: (chat_id, track_id, audio_url, caption); queued and marked seen atomically
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO outbox (chat_id, track_id, audio_url, caption) VALUES (?, ?, ?, ?)', notifications)
+                conn.executemany('INSERT OR REPLACE INTO seen_tracks (track_id, seen_at) VALUES (?, ?)', [(t, now) for t in track_ids])
+                conn.execute('DELETE FROM seen_tracks WHERE seen_at < ?', (now - SEEN_RETENTION,))
+
+    def due(self, limit):
+        with self._lock:
+            return self._connection().execute('SELECT id, chat_id, audio_url, caption, attempts FROM outbox WHERE next_attempt <= ? '
+                                              'ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+
+    def finish(self, done_ids, retries):
+        # done_ids are sent or given up; retries: (next_attempt, id)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in done_ids])
+                conn.executemany('UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ?', retries)
+
+    def pending(self):
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+
+class ReleaseNotifier:
+    def __init__(self):
+        self.outbox = Outbox(core.config.NOTIFY_DB_PATH)
+        self.subscriptions = core.get_subscriptions()
+        # Paces the fan-out below Telegram's global limit; per-chat limits and flood-wait retries
+        # are handled by send_audio_limited
+        self.bucket = core.TokenBucket(core.config.NOTIFY_RATE, core.config.NOTIFY_RATE)
+        self.executor = ThreadPoolExecutor(core.config.NOTIFY_WORKERS, thread_name_prefix='notify')
+        self.stats = {'polls': 0, 'new_tracks': 0, 'queued': 0, 'sent': 0, 'retried': 0, 'dropped': 0, 'unsubscribed': 0}
+
+    def poll(self):
+        success, data = core.safe_api_call('new_tracks', None, 0)
+        self.stats['polls'] += 1
+        if not success or data.get('stale'):
+            # A fallback answer is an old snapshot; diffing it would tell nothing new
+            logging.warning(f"Skipping release check, new_tracks unavailable: {data if not success else 'stale'}")
+            return
+        tracks = {str(t.id): t for t in core.parse_search_results(data, core.config.NOTIFY_SCAN_LIMIT) if t.kind == 'music' and t.audio_url}
+        first_run = not self.outbox.has_snapshot()
+        new_ids = self.outbox.unseen(list(tracks))
+        if first_run:
+            # Only releases that appear after the first snapshot are news
+            self.outbox.record_release(list(tracks), [])
+            logging.info(f"Recorded a first snapshot of {len(tracks)} new_tracks")
+            return
+        artist_keys = release_artist_keys(data)
+        subscribers = self.subscriptions.subscribers({key for t in new_ids for key in artist_keys.get(t, ())})
+        notifications = []
+        for track_id in new_ids:
+            track = tracks[track_id]
+            chats = {chat_id for key in artist_keys.get(track_id, ()) for chat_id in subscribers.get(key, ())}
+            caption = f"🔔 آهنگ جدید از {track.artist}: {track.title}"
+            notifications.extend((chat_id, track_id, track.audio_url, caption) for chat_id in chats)
+        # Still-listed tracks are recorded again to refresh their seen_at
+        self.outbox.record_release(list(tracks), notifications)
+        self.stats['new_tracks'] += len(new_ids)
+        self.stats['queued'] += len(notifications)
+        if new_ids:
+            logging.info(f"{len(new_ids)} new tracks, {len(notifications)} notifications queued")
+
+    def _send(self, row):
+        _, chat_id, audio_url, caption, attempts = row
+        self.bucket.acquire()
+        try:
+            core.send_audio_limited(chat_id, audio_url, caption, raise_errors=True)
+            return 'sent'
+        except Exception as e:
+            if getattr(e, 'error_code', None) == 403:
+                return 'blocked'
+            return 'dropped' if attempts + 1 >= core.config.NOTIFY_MAX_ATTEMPTS else 'retried'
+
+    def drain(self):
+        while True:
+            rows = self.outbox.due(core.config.NOTIFY_BATCH_SIZE)
+            if not rows:
+                return
+            results = list(self.executor.map(self._send, rows))
+            done, retries = [], []
+            for row, result in zip(rows, results):
+                if result == 'blocked':
+                    # The user blocked the bot or left the chat; stop notifying it
+                    self.stats['unsubscribed'] += self.subscriptions.remove(row[1])
+                    result = 'dropped'
+                NOTIFICATIONS.labels(result).inc()
+                self.stats[result] += 1
+                if result == 'retried':
+                    retries.append((time.time() + 60 * 2 ** row[4], row[0]))
+                else:
+                    done.append(row[0])
+            # Rows of a batch interrupted by a crash are still queued and go out again on restart
+            self.outbox.finish(done, retries)
+
+    def run(self):
+        pending = self.outbox.pending()
+        if pending:
+            logging.info(f"Resuming {pending} queued release notifications")
+        while True:
+            started = time.monotonic()
+            for step in (self.drain, self.poll, self.drain):
+                try:
+                    step()
+                except Exception as e:
+                    logging.error(f"Release notifier {step.__name__} failed: {e}")
+            logging.info(f"Release notifier: {self.stats}")
+            time.sleep(max(0.0, core.config.NOTIFY_POLL_INTERVAL - (time.monotonic() - started)))
+
+
+_lock_file = None
+
+
+def acquire_leadership():
+    # Non-blocking: only the first process on the host gets the lock; it is released when that process exits
+    global _lock_file
+    lock_file = open(core.config.NOTIFY_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _lock_file = lock_file
+    return True
+
+
+def start_in_background():
+    if not acquire_leadership():
+        return False
+    threading.Thread(target=ReleaseNotifier().run, name='release-notifier', daemon=True).start()
+    logging.info("Release notifier started in this process")
+    return True
+
+
+def main():
+    core.warm_up()
+    if not acquire_leadership():
+        logging.error(f"Another release notifier holds {core.config.NOTIFY_LOCK_PATH}")
+        return
+    notifier = ReleaseNotifier()
+    try:
+        notifier.run()
+    except KeyboardInterrupt:
+        logging.info(f"Release notifier stopped: {notifier.stats}")
+
+
+if __name__ == '__main__':
+    main()
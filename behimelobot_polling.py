@@ -0,0 +1,213 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from telebot import apihelper
+import behimelobot_render as core
+import behimelobot_notify
+import behimelobot_prefetch
+
+# Long-polling ingestion: an alternative to /webhook for local runs, hosts behind NAT and catching up
+# after a webhook outage. Each getUpdates batch is written to SQLite before its offset is confirmed
+# to Telegram, so a crash never loses a fetched update; updates of one chat are handled in order
+# while different chats are handled concurrently by the same command handlers as /webhook.
+#   python behimelobot_polling.py
+
+ALLOWED_UPDATES = ['message', 'callback_query', 'inline_query']
+
+
+# Fetched-but-unfinished updates plus the next getUpdates offset; replayed on restart
+class UpdateLog:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS pending_updates (update_id INTEGER PRIMARY KEY, body TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS polling_state (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def offset(self):
+        with self._lock:
+            row = self._connection().execute("SELECT value FROM polling_state WHERE name = 'offset'").fetchone()
+            return row[0] if row else None
+
+    def pending(self):
+        with self._lock:
+            rows = self._connection().execute('SELECT body FROM pending_updates ORDER BY update_id').fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def append(self, updates, offset):
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('INSERT OR IGNORE INTO pending_updates (update_id, body) VALUES (?, ?)',
+                             [(u['update_id'], json.dumps(u, ensure_ascii=False)) for u in updates])
+            conn.execute("INSERT OR REPLACE INTO polling_state (name, value) VALUES ('offset', ?)", (offset,))
+            conn.commit()
+
+    def done(self, update_id):
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute('DELETE FROM pending_updates WHERE update_id = ?', (update_id,))
+                conn.commit()
+            except sqlite3.Error as e:
+                # The update is replayed after a restart; dedup and idempotent handlers absorb it
+                logging.error(f"Could not mark update {update_id} done: {e}")
+
+
+# Runs items on a fixed pool of threads: FIFO per key, concurrent across keys. A key is in the ready
+# queue at most once, and a busy key goes back to the end after each item so one chat cannot
+# monopolize a worker.
+class PerChatDispatcher:
+    def __init__(self, handler, workers):
+        self.handler = handler
+        self._pending = {}  # key -> deque of waiting items; present while the key is queued or running
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'polling-worker-{i}', daemon=True).start()
+
+    def submit(self, key, item):
+        with self._lock:
+            items = self._pending.get(key)
+            if items is not None:
+                items.append(item)
+                return
+            self._pending[key] = deque([item])
+        self._ready.put(key)
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                item = self._pending[key].popleft()
+            try:
+                self.handler(item)
+            finally:
+                with self._lock:
+                    if self._pending[key]:
+                        self._ready.put(key)
+                    else:
+                        del self._pending[key]
+
+    def active_chats(self):
+        with self._lock:
+            return len(self._pending)
+
+
+class Poller:
+    def __init__(self):
+        self.log = UpdateLog(core.config.POLLING_DB_PATH)
+        self.dispatcher = PerChatDispatcher(self._handle, core.config.POLLING_WORKERS)
+        # Bounds fetched-but-unfinished updates; the fetch loop waits instead of buffering a backlog
+        self._slots = threading.Semaphore(core.config.POLLING_MAX_PENDING)
+        self._stats_lock = threading.Lock()
+        self.stats = {'batches': 0, 'fetched': 0, 'replayed': 0, 'processed': 0, 'failed': 0, 'duplicates': 0, 'rejected': 0, 'errors': 0}
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def _handle(self, update):
+        try:
+            # Fetching is already bounded by POLLING_MAX_PENDING, so only the per-chat limits apply here
+            admitted, reply = core.admit_update(update)
+            if not admitted:
+                self._count('rejected')
+                if reply:
+                    core.EFFECT_PERFORMERS[type(reply)](reply)
+                return
+            core.dispatch_update(update)
+            self._count('processed')
+        except Exception as e:
+            logging.error(f"Update {update.get('update_id')} processing error: {e}")
+            self._count('failed')
+        finally:
+            self.log.done(update['update_id'])
+            self._slots.release()
+
+    def submit(self, update):
+        if core._is_duplicate_update(update.get('update_id')):
+            self._count('duplicates')
+            self.log.done(update['update_id'])
+            return
+        self._slots.acquire()
+        # Inline queries are marked as their user's latest here, not when their turn in the user's FIFO
+        # comes, so queued keystrokes see the newer ones and skip the upstream search
+        delay = core.inline_debounce(update)
+        if delay:
+            core.get_delayed_calls().call_later(delay, self.dispatcher.submit, core.update_chat_key(update), update)
+        else:
+            self.dispatcher.submit(core.update_chat_key(update), update)
+
+    def _delete_webhook(self):
+        # getUpdates is refused (409) while a webhook is set
+        logging.warning("Deleting the bot's webhook to receive updates by long polling")
+        apihelper.delete_webhook(core.config.TELEGRAM_TOKEN)
+
+    def run(self):
+        core.get_bot()  # applies TELEGRAM_API_URL
+        self._delete_webhook()
+        offset = self.log.offset()
+        backlog = self.log.pending()
+        if backlog:
+            logging.info(f"Replaying {len(backlog)} updates left unfinished by the previous run")
+            self._count('replayed', len(backlog))
+            for update in backlog:
+                self.submit(update)
+        logging.info(f"Long polling started at offset {offset}")
+        backoff = 1
+        while True:
+            try:
+                updates = apihelper.get_updates(core.config.TELEGRAM_TOKEN, offset, core.config.POLLING_LIMIT, None,
+                                                ALLOWED_UPDATES, long_polling_timeout=core.config.POLLING_TIMEOUT)
+            except Exception as e:
+                self._count('errors')
+                if getattr(e, 'error_code', None) == 409:
+                    self._delete_webhook()
+                    continue
+                wait = core.retry_after_seconds(e) or backoff
+                logging.error(f"getUpdates failed: {e}; retrying in {wait}s")
+                time.sleep(wait)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 1
+            if not updates:
+                continue
+            offset = updates[-1]['update_id'] + 1
+            # Persist before the next getUpdates confirms this batch to Telegram
+            self.log.append(updates, offset)
+            self._count('batches')
+            self._count('fetched', len(updates))
+            for update in updates:
+                self.submit(update)
+            logging.info(f"Fetched {len(updates)} updates, next offset {offset}, {self.dispatcher.active_chats()} chats busy")
+
+
+def main():
+    core.warm_up()
+    if core.config.NOTIFY_ENABLED:
+        behimelobot_notify.start_in_background()
+    if core.config.PREFETCH_ENABLED:
+        behimelobot_prefetch.start_in_background()
+    poller = Poller()
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        # Unfinished updates stay in the log and are replayed on the next start
+        logging.info(f"Long polling stopped: {poller.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import logging
+import os
+import socket
+import threading
+import time
+import behimelobot_render as core
+
+# Keeps the hot feeds (commands registered with prefetch=True) warm in every worker. Each process runs
+# this loop, but only the holder of the 'prefetch' lease in the shared store refetches the feeds every
+# PREFETCH_INTERVAL seconds and stores the responses and their rendered reply text there; button
+# presses in any worker are then answered from that text. If the leader dies its lease lapses and
+# another worker takes over on its next tick; until then, once the text expires, presses fall back to
+# the usual cached API call.
+#   python behimelobot_prefetch.py
+#   PREFETCH_ENABLED=1 gunicorn ...   (gunicorn.conf.py starts it in every worker)
+
+LEASE = 'prefetch'
+
+
+class FeedPrefetcher:
+    def __init__(self, shared):
+        self.shared = shared
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.stats = {'runs': 0, 'refreshed': 0, 'failed': 0}
+
+    def refresh(self):
+        self.stats['runs'] += 1
+        for command in core.COMMANDS.values():
+            if not command.prefetch:
+                continue
+            # Straight to upstream: the point is to replace what the caches hold
+            success, data = core._fetch_and_store(core.api_cache_key(command.action), command.action, None, command.cache_ttl)
+            if not success:
+                # The previous text stays until it expires; after that presses fall back to a live call
+                logging.warning(f"Prefetch of {command.action} failed: {data}")
+                self.stats['failed'] += 1
+                continue
+            # Kept no longer than the feed's own cache TTL, so a dead leader never serves an older feed than the cache would
+            self.shared.set(core.feed_text_key(command.name), {'text': command.formatter(data, ''), 'rendered_at': time.time()},
+                            core.cache_ttl_for(command.action, command.cache_ttl))
+            self.stats['refreshed'] += 1
+        logging.info(f"Prefetched feeds as {self.owner}: {self.stats}")
+
+    def run(self):
+        interval = core.config.PREFETCH_INTERVAL
+        while True:
+            started = time.monotonic()
+            try:
+                if self.shared.acquire_lease(LEASE, self.owner, interval * 1.5):
+                    self.refresh()
+            except Exception as e:
+                logging.error(f"Feed prefetch failed: {e}")
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+_started = False
+
+
+def start_in_background():
+    global _started
+    shared = core.get_shared_cache()
+    if _started or shared is None:
+        return False
+    _started = True
+    threading.Thread(target=FeedPrefetcher(shared).run, name='feed-prefetch', daemon=True).start()
+    logging.info("Feed prefetcher started in this process")
+    return True
+
+
+def main():
+    core.warm_up()
+    shared = core.get_shared_cache()
+    if shared is None:
+        logging.error("SHARED_CACHE_URL is empty; there is nowhere to prefetch feeds to")
+        return
+    prefetcher = FeedPrefetcher(shared)
+    try:
+        prefetcher.run()
+    except KeyboardInterrupt:
+        logging.info(f"Feed prefetcher stopped: {prefetcher.stats}")
+
+
+if __name__ == '__main__':
+    main()
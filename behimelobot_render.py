@@ -1,25 +1,46 @@
+import time
+_import_started = time.perf_counter()  # the startup budget counts our own imports too
 import os
+import gzip
 import json
 import logging
+import queue
+import threading
 import requests
-from flask import Flask, request, jsonify, render_template_string, send_from_directory
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, jsonify, send_from_directory, g
 from datetime import datetime
 import re
+import hashlib
+import itertools
+import math
+import atexit
+import heapq
+import unicodedata
+import sqlite3
+import contextlib
+import contextvars
+import logging.handlers
+import random
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import telebot
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize Telegram Bot
-TELEGRAM_TOKEN = None
-ACCESS_KEY = None
-API_BASE = None
-WEBHOOK_URL = None
-PORT = None
-bot = None
-
 def load_env_from_secrets():
-    global TELEGRAM_TOKEN, ACCESS_KEY, API_BASE, WEBHOOK_URL, PORT, bot
     try:
         env_path = '/etc/secrets/.env'
         if os.path.exists(env_path):
@@ -33,34 +54,452 @@ def load_env_from_secrets():
     except Exception as e:
         logging.error(f"Error loading environment variables: {e}")
 
-    TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-    ACCESS_KEY = os.getenv('ACCESS_KEY')
-    API_BASE = os.getenv('API_BASE', 'https://api.ineo-team.ir/rj.php')
-    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
-    PORT = int(os.getenv('PORT', 4000))
+# Settings come from /etc/secrets/.env and the environment. They are read on first use rather than at
+# import, so importing this module (gunicorn --preload, the benchmark, a shell) is cheap and never
+# fails; create_app() loads and validates them up front.
+class Config:
+    def __init__(self):
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Only reached while settings are not loaded yet; afterwards they are plain attributes
+        if name.startswith('_') or self._loaded:
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            load_env_from_secrets()
+            self.TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+            self.ACCESS_KEY = os.getenv('ACCESS_KEY')
+            self.API_BASE = os.getenv('API_BASE', 'https://api.ineo-team.ir/rj.php')
+            self.WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+            # Base URL of a self-hosted Bot API server (or the benchmark's stand-in) instead of api.telegram.org
+            self.TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+            self.PORT = int(os.getenv('PORT', 4000))
+            self.API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 10))
+            self.API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', 3.05))
+            self.API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', 15))
+            self.API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', 2))
+            self.API_RETRY_BACKOFF = float(os.getenv('API_RETRY_BACKOFF', 0.5))
+            self.API_CACHE_MAX_ENTRIES = int(os.getenv('API_CACHE_MAX_ENTRIES', 1024))
+            self.API_CACHE_STALE_TTL = int(os.getenv('API_CACHE_STALE_TTL', 3600))
+            # Seconds a successful response stays fresh; override with CACHE_TTL_<ACTION>, 0 disables
+            default_ttls = {'new_tracks': 300, 'trending_tracks': 300, 'top_artists': 1800, 'special_playlist': 1800, 'search': 600}
+            self.CACHE_TTLS = {action: int(os.getenv(f'CACHE_TTL_{action.upper()}', ttl)) for action, ttl in default_ttls.items()}
+            self.WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+            self.WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+            self.UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 10000))
+            # How long update_ids stay claimed in the shared store, which dedups across workers
+            self.UPDATE_DEDUP_TTL = float(os.getenv('UPDATE_DEDUP_TTL', 3600))
+            self.MAX_AUDIO_PER_SEARCH = int(os.getenv('MAX_AUDIO_PER_SEARCH', 5))
+            self.AUDIO_SEND_WORKERS = int(os.getenv('AUDIO_SEND_WORKERS', 8))
+            self.AUDIO_SEND_RETRIES = int(os.getenv('AUDIO_SEND_RETRIES', 2))
+            # Telegram allows ~30 messages/s overall and about one per second in a single chat
+            self.TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+            self.TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+            self.TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 3))
+            self.FILE_ID_DB_PATH = os.getenv('FILE_ID_DB_PATH', '/tmp/behimelobot_file_ids.db')
+            self.FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', 50000))
+            self.INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', 0.35))
+            self.INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+            self.INLINE_MIN_QUERY_LENGTH = int(os.getenv('INLINE_MIN_QUERY_LENGTH', 2))
+            self.INLINE_MAX_RESULTS = int(os.getenv('INLINE_MAX_RESULTS', 20))
+            self.RECENT_SEARCHES_SIZE = int(os.getenv('RECENT_SEARCHES_SIZE', 512))
+            self.SEARCH_INDEX_PATH = os.getenv('SEARCH_INDEX_PATH', '/tmp/behimelobot_search_index.json')
+            self.SEARCH_INDEX_MAX_ENTRIES = int(os.getenv('SEARCH_INDEX_MAX_ENTRIES', 50000))
+            self.SEARCH_INDEX_SAVE_INTERVAL = int(os.getenv('SEARCH_INDEX_SAVE_INTERVAL', 60))
+            self.API_SEARCH_RESULTS = int(os.getenv('API_SEARCH_RESULTS', 30))
+            self.API_SEARCH_MAX_AGE = int(os.getenv('API_SEARCH_MAX_AGE', 60))
+            # Bot search results beyond one page are kept server-side under a short token for RESULT_PAGES_TTL
+            # seconds, so next/prev buttons edit the message without another upstream call
+            self.SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 10))
+            self.SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 50))
+            self.RESULT_PAGES_TTL = int(os.getenv('RESULT_PAGES_TTL', 1800))
+            self.RESULT_PAGES_MAX = int(os.getenv('RESULT_PAGES_MAX', 5000))
+            self.WEBAPP_MAX_AGE = int(os.getenv('WEBAPP_MAX_AGE', 86400))
+            # The upstream breaker opens when, over the last BREAKER_WINDOW seconds (and at least
+            # BREAKER_MIN_CALLS calls), the error rate or the share of calls slower than BREAKER_SLOW_CALL
+            # seconds reaches its threshold
+            self.BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', 60))
+            self.BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 10))
+            self.BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', 0.5))
+            self.BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', 5))
+            self.BREAKER_SLOW_RATE = float(os.getenv('BREAKER_SLOW_RATE', 0.8))
+            self.BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+            self.BREAKER_PROBES = int(os.getenv('BREAKER_PROBES', 2))
+            self.METRICS_REFRESH_INTERVAL = float(os.getenv('METRICS_REFRESH_INTERVAL', 15))
+            # Seconds from interpreter start to a ready app before startup is logged as too slow
+            self.STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', 2))
+            # Long-polling ingestion (behimelobot_polling); POLLING_TIMEOUT is getUpdates' long-poll wait
+            self.POLLING_LIMIT = int(os.getenv('POLLING_LIMIT', 100))
+            self.POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 50))
+            self.POLLING_WORKERS = int(os.getenv('POLLING_WORKERS', 16))
+            self.POLLING_MAX_PENDING = int(os.getenv('POLLING_MAX_PENDING', 5000))
+            self.POLLING_DB_PATH = os.getenv('POLLING_DB_PATH', '/tmp/behimelobot_polling.db')
+            # Admission control. Limits are "rate/burst" (sustained requests per second/bucket size), 0
+            # disables one. Commands are limited per chat: register_command gives the default,
+            # RATE_LIMIT_DEFAULT covers the rest and RATE_LIMIT_<COMMAND> overrides either.
+            self.RATE_LIMIT_DEFAULT = os.getenv('RATE_LIMIT_DEFAULT', '1/10')
+            self.RATE_LIMITS = {key[len('RATE_LIMIT_'):].lower(): value for key, value in os.environ.items() if key.startswith('RATE_LIMIT_')}
+            self.RATE_LIMIT_NOTICE_INTERVAL = float(os.getenv('RATE_LIMIT_NOTICE_INTERVAL', 30))
+            self.API_SEARCH_RATE_LIMIT = os.getenv('API_SEARCH_RATE_LIMIT', '1/10')  # per client IP
+            # Updates queued or running, and concurrent /api/search calls, per process before new ones are refused
+            self.MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', 200))
+            self.API_SEARCH_MAX_IN_FLIGHT = int(os.getenv('API_SEARCH_MAX_IN_FLIGHT', 16))
+            # Updates in flight in the asyncio mode (behimelobot_async); takes MAX_PENDING_UPDATES' place there
+            self.ASYNC_MAX_UPDATES = int(os.getenv('ASYNC_MAX_UPDATES', 2000))
+            # Proxies in front of the app that append to X-Forwarded-For (Render's load balancer)
+            self.PROXY_HOPS = int(os.getenv('PROXY_HOPS', 1))
+            self.SUBSCRIPTIONS_DB_PATH = os.getenv('SUBSCRIPTIONS_DB_PATH', '/tmp/behimelobot_subscriptions.db')
+            self.MAX_SUBSCRIPTIONS_PER_CHAT = int(os.getenv('MAX_SUBSCRIPTIONS_PER_CHAT', 50))
+            # New-release notifications (behimelobot_notify). NOTIFY_RATE shares Telegram's ~30 messages/s
+            # with interactive replies, so leave them some headroom.
+            self.NOTIFY_ENABLED = os.getenv('NOTIFY_ENABLED', '') in ('1', 'true', 'yes')
+            self.NOTIFY_DB_PATH = os.getenv('NOTIFY_DB_PATH', '/tmp/behimelobot_notify.db')
+            self.NOTIFY_LOCK_PATH = os.getenv('NOTIFY_LOCK_PATH', '/tmp/behimelobot_notify.lock')
+            self.NOTIFY_POLL_INTERVAL = float(os.getenv('NOTIFY_POLL_INTERVAL', 300))
+            self.NOTIFY_SCAN_LIMIT = int(os.getenv('NOTIFY_SCAN_LIMIT', 100))
+            self.NOTIFY_RATE = float(os.getenv('NOTIFY_RATE', 20))
+            self.NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', 100))
+            self.NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', 8))
+            self.NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', 5))
+            # Store shared by all workers for the hot feeds and their pre-rendered text: sqlite://<path>,
+            # redis://host:port/db (any Redis-compatible server; needs the redis package) or empty to disable
+            self.SHARED_CACHE_URL = os.getenv('SHARED_CACHE_URL', 'sqlite:///tmp/behimelobot_shared_cache.db')
+            # One worker (the lease holder) refetches and pre-renders the feeds every PREFETCH_INTERVAL seconds
+            self.PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '1') in ('1', 'true', 'yes')
+            self.PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', 240))
+            # Logging: json or text lines; LOG_SAMPLE_RATE is the share of high-volume INFO/DEBUG lines kept
+            self.LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+            self.LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+            self.LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+            self.LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', 2000))
+            self.LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+            self._loaded = True
+
+    def require(self, *names):
+        for name in names:
+            if not getattr(self, name):
+                logging.error(f"{name} is not set")
+                raise ValueError(f"{name} is required")
+
+config = Config()
+
+def telegram_api_url_template():
+    return config.TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
+# One TeleBot per process, built on first use. threaded=False: updates are dispatched by our own
+# workers, so telebot's handler pool would only be idle threads that do not survive a fork.
+_bot = None
+_bot_pid = None
+_bot_lock = threading.Lock()
+
+def get_bot():
+    global _bot, _bot_pid
+    pid = os.getpid()
+    if _bot is None or _bot_pid != pid:
+        with _bot_lock:
+            if _bot is None or _bot_pid != pid:
+                if config.TELEGRAM_API_URL:
+                    telebot.apihelper.API_URL = telegram_api_url_template()
+                _bot = telebot.TeleBot(config.TELEGRAM_TOKEN, threaded=False)
+                _bot_pid = pid
+    return _bot
+
+# Logging: request threads only enqueue records; a listener thread formats and writes them. Hot-path
+# lines use %-style arguments so even the message is built off the request thread, and pass
+# extra=SAMPLED to be thinned to LOG_SAMPLE_RATE. Warnings and errors are always kept.
+SAMPLED = {'sampled': True}
+_log_context = contextvars.ContextVar('log_context', default={})
+_log_listener = None
+_log_handler = None
+_log_stats_lock = threading.Lock()
+log_stats = {'dropped': 0, 'sampled_out': 0}
+
+@contextlib.contextmanager
+def log_context(**fields):
+    # Fields (update_id, request_id, command, ...) added to every record logged inside the block
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+def _count_log_stat(name):
+    with _log_stats_lock:
+        log_stats[name] += 1
+
+class LogSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and getattr(record, 'sampled', False) and random.random() >= self.rate:
+            _count_log_stat('sampled_out')
+            return False
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Unlike QueueHandler, leaves formatting to the listener; only the context is captured here
+    def prepare(self, record):
+        record.context = _log_context.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request on logging; the loss shows up in /health
+            _count_log_stat('dropped')
+
+class LogFormatter(logging.Formatter):
+    def __init__(self, as_json, max_length):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+        self.as_json = as_json
+        self.max_length = max_length
+
+    def _truncate(self, text):
+        if len(text) <= self.max_length:
+            return text
+        return f"{text[:self.max_length]}… [{len(text)} chars]"
+
+    def format(self, record):
+        message = self._truncate(record.getMessage())
+        if not self.as_json:
+            record.message = message
+            line = f"{self.formatTime(record)} - {record.levelname} - {message}"
+            context = getattr(record, 'context', None)
+            if context:
+                line += ' ' + ' '.join(f"{key}={value}" for key, value in context.items())
+            if record.exc_info:
+                line += '\n' + self._truncate(self.formatException(record.exc_info))
+            return line
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': message,
+        }
+        entry.update(getattr(record, 'context', None) or {})
+        if record.exc_info:
+            entry['exc'] = self._truncate(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def _start_log_listener():
+    global _log_listener
+    log_queue = queue.Queue(config.LOG_QUEUE_SIZE)
+    output = logging.StreamHandler()
+    output.setFormatter(LogFormatter(config.LOG_FORMAT == 'json', config.LOG_MAX_LENGTH))
+    _log_handler.queue = log_queue
+    _log_listener = logging.handlers.QueueListener(log_queue, output)
+    _log_listener.start()
+
+def _restart_log_listener_after_fork():
+    # The listener thread does not survive a fork (gunicorn --preload); the child starts its own
+    if _log_handler is not None:
+        _start_log_listener()
+
+def configure_logging():
+    global _log_handler
+    if _log_handler is not None:
+        return
+    _log_handler = DeferredQueueHandler(None)
+    _log_handler.addFilter(LogSampler(config.LOG_SAMPLE_RATE))
+    _start_log_listener()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_log_handler)
+    root.setLevel(config.LOG_LEVEL)
+    os.register_at_fork(after_in_child=_restart_log_listener_after_fork)
+    atexit.register(lambda: _log_listener.stop())
+
+def get_log_stats():
+    with _log_stats_lock:
+        stats = dict(log_stats)
+    stats['queue_depth'] = _log_handler.queue.qsize() if _log_handler is not None else 0
+    stats['queue_size'] = config.LOG_QUEUE_SIZE
+    stats['sample_rate'] = config.LOG_SAMPLE_RATE
+    return stats
+
+# Prometheus metrics. With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py
+# prepares it): every worker then writes its samples to mmap'd files that /metrics merges.
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+UPSTREAM_LATENCY = Histogram('behimelobot_upstream_request_seconds', 'Upstream API call latency, retries included', ['action'], buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter('behimelobot_upstream_errors_total', 'Failed upstream API calls; reason is error or rejected (breaker open)', ['action', 'reason'])
+TELEGRAM_LATENCY = Histogram('behimelobot_telegram_request_seconds', 'Telegram Bot API call latency', ['method'], buckets=LATENCY_BUCKETS)
+TELEGRAM_ERRORS = Counter('behimelobot_telegram_errors_total', 'Failed Telegram Bot API calls by error code', ['method', 'code'])
+COMMAND_LATENCY = Histogram('behimelobot_command_seconds', 'Time to handle one update, by command', ['command'], buckets=LATENCY_BUCKETS)
+COMMAND_ERRORS = Counter('behimelobot_command_errors_total', 'Updates whose command handler raised', ['command'])
+HTTP_LATENCY = Histogram('behimelobot_http_request_seconds', 'HTTP request latency by route', ['route'], buckets=LATENCY_BUCKETS)
+HTTP_REQUESTS = Counter('behimelobot_http_requests_total', 'HTTP requests by route and status', ['route', 'status'])
+IN_FLIGHT = Gauge('behimelobot_in_flight', 'Operations in progress: http, updates, upstream, telegram', ['kind'], multiprocess_mode='livesum')
+BREAKER_STATE = Gauge('behimelobot_upstream_breaker_state', 'Upstream circuit breaker state: 0 closed, 1 half-open, 2 open', multiprocess_mode='liveall')
+BREAKER_TRANSITIONS = Counter('behimelobot_upstream_breaker_transitions_total', 'Upstream circuit breaker state changes', ['to'])
+REJECTIONS = Counter('behimelobot_rejections_total', 'Updates and /api/search calls refused by admission control; reason is rate_limited or busy', ['command', 'reason'])
+COMPONENT_STATS = Gauge('behimelobot_component_stat', 'Numeric counters and sizes reported by /health', ['component', 'stat'], multiprocess_mode='liveall')
+
+# labels() locks the metric and builds a key on every call; resolved children are looked up lock-free
+_metric_children = {}
+
+def metric_child(metric, *labels):
+    child = _metric_children.get((metric, labels))
+    if child is None:
+        child = _metric_children[(metric, labels)] = metric.labels(*labels)
+    return child
+
+def record_upstream(action, latency, success):
+    metric_child(UPSTREAM_LATENCY, action).observe(latency)
+    if not success:
+        metric_child(UPSTREAM_ERRORS, action, 'error').inc()
+
+@contextlib.contextmanager
+def telegram_call(method):
+    in_flight = metric_child(IN_FLIGHT, 'telegram')
+    in_flight.inc()
+    started = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        metric_child(TELEGRAM_ERRORS, method, str(getattr(e, 'error_code', None) or 'exception')).inc()
+        raise
+    finally:
+        in_flight.dec()
+        metric_child(TELEGRAM_LATENCY, method).observe(time.monotonic() - started)
+
+_stats_exported_at = 0.0
+
+def export_stats(payload):
+    for component, stats in payload.items():
+        if not isinstance(stats, dict):
+            continue
+        for name, value in stats.items():
+            if isinstance(value, (int, float)):
+                metric_child(COMPONENT_STATS, component, name).set(value)
 
-    if not TELEGRAM_TOKEN:
-        logging.error("TELEGRAM_TOKEN is not set")
-        raise ValueError("TELEGRAM_TOKEN is required")
-    if not ACCESS_KEY:
-        logging.error("ACCESS_KEY is not set")
-        raise ValueError("ACCESS_KEY is required")
+def refresh_stat_gauges(force=False):
+    # Each worker republishes its /health numbers now and then so a scrape served by any worker sees all
+    global _stats_exported_at
+    now = time.monotonic()
+    if force or now - _stats_exported_at >= config.METRICS_REFRESH_INTERVAL:
+        _stats_exported_at = now
+        export_stats(health_payload())
 
-    # Initialize bot
-    bot = telebot.TeleBot(TELEGRAM_TOKEN)
+def metrics_body():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
 
-load_env_from_secrets()
+# Read-only upstream actions that are safe to retry on connection errors and 5xx
+IDEMPOTENT_ACTIONS = {'search', 'new_tracks', 'trending_tracks', 'top_artists', 'special_playlist', 'random_track'}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Actions whose identical concurrent calls may share one upstream request
+COALESCED_ACTIONS = IDEMPOTENT_ACTIONS - {'random_track'}
 
-def safe_api_call(action: str, params: dict = None):
+# One pooled keep-alive session per worker process; recreated after fork
+_api_session = None
+_api_session_pid = None
+_api_session_lock = threading.Lock()
+_api_stats_lock = threading.Lock()
+api_client_stats = {'calls': 0, 'retries': 0, 'errors': 0, 'degraded': 0}
+
+def get_api_session():
+    global _api_session, _api_session_pid
+    pid = os.getpid()
+    if _api_session is None or _api_session_pid != pid:
+        with _api_session_lock:
+            if _api_session is None or _api_session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.API_POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['Connection'] = 'keep-alive'
+                _api_session = session
+                _api_session_pid = pid
+    return _api_session
+
+def get_api_pool_stats():
+    requests_sent = 0
+    new_connections = 0
+    session = _api_session if _api_session_pid == os.getpid() else None
+    if session is not None:
+        for adapter in {id(a): a for a in session.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_sent += pool.num_requests
+                new_connections += pool.num_connections
+    with _api_stats_lock:
+        stats = dict(api_client_stats)
+    stats.update({
+        'pool_size': config.API_POOL_SIZE,
+        'requests': requests_sent,
+        'new_connections': new_connections,
+        'pool_hits': max(requests_sent - new_connections, 0),
+    })
+    return stats
+
+def _count_api_stat(name):
+    with _api_stats_lock:
+        api_client_stats[name] += 1
+
+UPSTREAM_UNAVAILABLE = "سرویس موزیک موقتاً در دسترس نیست، لطفاً کمی بعد دوباره تلاش کنید"
+
+def _fetch_upstream(action: str, params: dict = None):
+    breaker = get_api_breaker()
+    ticket = breaker.allow()
+    if ticket is None:
+        metric_child(UPSTREAM_ERRORS, action, 'rejected').inc()
+        return False, UPSTREAM_UNAVAILABLE
+    in_flight = metric_child(IN_FLIGHT, 'upstream')
+    in_flight.inc()
+    started = time.monotonic()
     try:
-        if not ACCESS_KEY:
+        success, data = _post_upstream(action, params)
+    finally:
+        in_flight.dec()
+    latency = time.monotonic() - started
+    breaker.record(ticket, success, latency)
+    record_upstream(action, latency, success)
+    return success, data
+
+def _post_upstream(action: str, params: dict = None):
+    try:
+        if not config.ACCESS_KEY:
             logging.error("ACCESS_KEY is not set")
             return False, "ACCESS_KEY تنظیم نشده"
-        post_data = {'accessKey': ACCESS_KEY, 'action': action}
+        post_data = {'accessKey': config.ACCESS_KEY, 'action': action}
         if params:
             post_data.update(params)
-        response = requests.post(API_BASE, data=post_data, timeout=15)
-        logging.info(f"API call: action={action}, params={params}, status={response.status_code}, response={response.text}")
+        _count_api_stat('calls')
+        session = get_api_session()
+        attempts = 1 + (config.API_MAX_RETRIES if action in IDEMPOTENT_ACTIONS else 0)
+        for attempt in range(attempts):
+            if attempt:
+                _count_api_stat('retries')
+                time.sleep(config.API_RETRY_BACKOFF * (2 ** (attempt - 1)))
+                logging.warning(f"Retrying API call: action={action}, attempt={attempt + 1}/{attempts}")
+            try:
+                response = session.post(config.API_BASE, data=post_data, timeout=(config.API_CONNECT_TIMEOUT, config.API_READ_TIMEOUT))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt + 1 < attempts:
+                    logging.warning(f"API call {action} failed: {e}")
+                    continue
+                raise
+            if response.status_code in RETRY_STATUS_CODES and attempt + 1 < attempts:
+                continue
+            break
+        logging.info("API call: action=%s, params=%s, status=%s, size=%d", action, params, response.status_code, len(response.content), extra=SAMPLED)
         if response.status_code == 200:
             try:
                 data = response.json()
@@ -72,189 +511,2262 @@ def safe_api_call(action: str, params: dict = None):
                 return False, "Invalid JSON response"
         else:
             logging.error(f"API request failed with status {response.status_code}")
+            _count_api_stat('errors')
             return False, f"HTTP {response.status_code}"
     except Exception as e:
         logging.error(f"API call error: {e}")
+        _count_api_stat('errors')
         return False, str(e)
 
+# Thread-safe LRU cache; entries are fresh for `ttl`, then served stale for `stale_ttl` while refreshed
+class TTLCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'evictions': 0, 'refreshes': 0}
+
+    def get(self, key):
+        # Returns (value, fresh); value is None on a miss
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or now >= entry[2]:
+                if entry is not None:
+                    del self._data[key]
+                self._stats['misses'] += 1
+                return None, False
+            self._data.move_to_end(key)
+            if now < entry[1]:
+                self._stats['hits'] += 1
+                return entry[0], True
+            self._stats['stale_hits'] += 1
+            return entry[0], False
+
+    def set(self, key, value, ttl, stale_ttl=0):
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (value, now + ttl, now + ttl + stale_ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+        stats['max_entries'] = self.max_entries
+        return stats
+
+# Key/value store with expiry that every worker (and, with Redis, every host) sees. Values are JSON.
+# Also grants named leases so that exactly one worker runs a background job. Failures are logged
+# and treated as misses: the shared store only ever saves work.
+class SqliteSharedCache:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._stats = {'hits': 0, 'misses': 0, 'sets': 0, 'errors': 0}
+
+    def _connection(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS shared_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            try:
+                row = self._connection().execute('SELECT value FROM shared_cache WHERE key = ? AND expires > ?', (key, time.time())).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"Shared cache lookup failed: {e}")
+                self._stats['errors'] += 1
+                return None
+            self._stats['hits' if row else 'misses'] += 1
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        body = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            try:
+                conn = self._connection()
+                now = time.time()
+                conn.execute('INSERT OR REPLACE INTO shared_cache (key, value, expires) VALUES (?, ?, ?)', (key, body, now + ttl))
+                self._purge_expired(conn, now)
+                conn.commit()
+                self._stats['sets'] += 1
+            except sqlite3.Error as e:
+                logging.error(f"Shared cache store failed: {e}")
+                self._stats['errors'] += 1
+
+    def _purge_expired(self, conn, now):
+        self._sets += 1
+        if self._sets % 100 == 1:
+            conn.execute('DELETE FROM shared_cache WHERE expires <= ?', (now,))
+
+    def claim(self, key, ttl):
+        # Stores key unless another worker holds it unexpired; True when this call stored it. On
+        # errors it answers True, so a failing store never makes work look done
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                won = conn.execute('INSERT INTO shared_cache (key, value, expires) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                                   'value = excluded.value, expires = excluded.expires WHERE shared_cache.expires <= ?',
+                                   (key, '1', now + ttl, now)).rowcount
+                self._purge_expired(conn, now)
+                conn.commit()
+                return won > 0
+            except sqlite3.Error as e:
+                logging.error(f"Shared cache claim failed: {e}")
+                self._stats['errors'] += 1
+                return True
+
+    def delete(self, key):
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute('DELETE FROM shared_cache WHERE key = ?', (key,))
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Shared cache delete failed: {e}")
+                self._stats['errors'] += 1
+
+    def acquire_lease(self, name, owner, ttl):
+        # Takes a free or expired lease, or renews our own; one statement, so concurrent workers cannot both win
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                won = conn.execute('INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                                   'owner = excluded.owner, expires = excluded.expires WHERE leases.owner = excluded.owner OR leases.expires <= ?',
+                                   (name, owner, now + ttl, now)).rowcount
+                conn.commit()
+                return won > 0
+            except sqlite3.Error as e:
+                logging.error(f"Lease {name} check failed: {e}")
+                self._stats['errors'] += 1
+                return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = 'sqlite'
+        return stats
+
+class RedisSharedCache:
+    def __init__(self, url):
+        if redis is None:
+            raise ValueError("SHARED_CACHE_URL points at Redis but the redis package is not installed")
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'sets': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key):
+        try:
+            body = self.client.get(key)
+        except redis.RedisError as e:
+            logging.error(f"Shared cache lookup failed: {e}")
+            self._count('errors')
+            return None
+        self._count('hits' if body is not None else 'misses')
+        return json.loads(body) if body is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(key, json.dumps(value, ensure_ascii=False), px=max(1, int(ttl * 1000)))
+            self._count('sets')
+        except redis.RedisError as e:
+            logging.error(f"Shared cache store failed: {e}")
+            self._count('errors')
+
+    def claim(self, key, ttl):
+        try:
+            return bool(self.client.set(key, 1, nx=True, px=max(1, int(ttl * 1000))))
+        except redis.RedisError as e:
+            logging.error(f"Shared cache claim failed: {e}")
+            self._count('errors')
+            return True
+
+    def delete(self, key):
+        try:
+            self.client.delete(key)
+        except redis.RedisError as e:
+            logging.error(f"Shared cache delete failed: {e}")
+            self._count('errors')
+
+    def acquire_lease(self, name, owner, ttl):
+        # Plain SET NX / GET / SET XX rather than a script, so simple Redis stand-ins work too
+        key, px = f"lease:{name}", max(1, int(ttl * 1000))
+        try:
+            if self.client.set(key, owner, nx=True, px=px):
+                return True
+            current = self.client.get(key)
+            return current is not None and current.decode() == owner and bool(self.client.set(key, owner, xx=True, px=px))
+        except redis.RedisError as e:
+            logging.error(f"Lease {name} check failed: {e}")
+            self._count('errors')
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = 'redis'
+        return stats
+
+def open_shared_cache(url):
+    if not url:
+        return None
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSharedCache(url)
+    return SqliteSharedCache(url.removeprefix('sqlite://'))
+
+# Lets identical concurrent calls share one execution; every waiter gets the leader's result or exception
+class SingleFlight:
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'originating': 0, 'coalesced': 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+                self._stats['originating'] += 1
+            else:
+                self._stats['coalesced'] += 1
+        if not leader:
+            call.event.wait()
+        else:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+# Opens when the error or slow-call rate over a rolling window crosses its threshold, fails fast for
+# open_seconds, then lets up to `probes` calls through; that many healthy probes close it again
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, window, min_calls, error_rate, slow_call, slow_rate, open_seconds, probes):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = max(probes, 1)
+        self.state = self.CLOSED
+        self._calls = deque()  # (finished_at, failed, slow) for calls made while closed
+        self._failed = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._transitions = deque(maxlen=20)
+        self._stats = {'rejected': 0, 'opened': 0, 'failures': 0, 'slow_calls': 0}
+        self._lock = threading.Lock()
+
+    def allow(self):
+        # Returns None when the call must fail fast, else a ticket to hand back to record()
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self._stats['rejected'] += 1
+                    return None
+                self._transition(self.HALF_OPEN, 'open period elapsed')
+            if self.state == self.HALF_OPEN:
+                if self._probes_in_flight >= self.probes:
+                    self._stats['rejected'] += 1
+                    return None
+                self._probes_in_flight += 1
+            return self.state
+
+    def release(self, ticket):
+        # For calls that were abandoned (e.g. cancelled) before they had an outcome
+        with self._lock:
+            if ticket == self.HALF_OPEN:
+                self._probes_in_flight -= 1
+
+    def record(self, ticket, ok, latency):
+        slow = latency >= self.slow_call
+        now = time.monotonic()
+        with self._lock:
+            self._stats['failures'] += not ok
+            self._stats['slow_calls'] += slow
+            if ticket == self.HALF_OPEN:
+                self._probes_in_flight -= 1
+                if self.state != self.HALF_OPEN:
+                    return
+                if not ok or slow:
+                    self._open(now, 'probe failed' if not ok else f'probe took {latency:.1f}s')
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.probes:
+                    self._transition(self.CLOSED, f'{self._probe_successes} probes succeeded')
+                return
+            if self.state != self.CLOSED:
+                return
+            self._calls.append((now, not ok, slow))
+            self._failed += not ok
+            self._slow += slow
+            self._prune(now)
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            if self._failed / calls >= self.error_rate:
+                self._open(now, f'error rate {self._failed}/{calls}')
+            elif self._slow / calls >= self.slow_rate:
+                self._open(now, f'slow-call rate {self._slow}/{calls}')
+
+    def _prune(self, now):
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, failed, slow = self._calls.popleft()
+            self._failed -= failed
+            self._slow -= slow
+
+    def _open(self, now, reason):
+        self._opened_at = now
+        self._stats['opened'] += 1
+        self._transition(self.OPEN, reason)
+
+    def _transition(self, state, reason):
+        logging.warning(f"Upstream circuit breaker {self.state} -> {state}: {reason}")
+        self._transitions.append({'from': self.state, 'to': state, 'reason': reason,
+                                  'at': datetime.now().isoformat(timespec='seconds')})
+        self.state = state
+        BREAKER_STATE.set(self.STATE_VALUES[state])
+        metric_child(BREAKER_TRANSITIONS, state).inc()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._calls.clear()
+        self._failed = self._slow = 0
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            calls = len(self._calls)
+            stats = dict(self._stats)
+            stats.update({
+                'state': self.state,
+                'window_calls': calls,
+                'error_rate': round(self._failed / calls, 3) if calls else 0.0,
+                'slow_rate': round(self._slow / calls, 3) if calls else 0.0,
+                'retry_in': round(max(self._opened_at + self.open_seconds - time.monotonic(), 0), 1)
+                            if self.state == self.OPEN else 0,
+                'transitions': list(self._transitions),
+            })
+        return stats
+
+_api_breaker = None
+_api_breaker_lock = threading.Lock()
+
+def get_api_breaker():
+    global _api_breaker
+    if _api_breaker is None:
+        with _api_breaker_lock:
+            if _api_breaker is None:
+                _api_breaker = CircuitBreaker(config.BREAKER_WINDOW, config.BREAKER_MIN_CALLS, config.BREAKER_ERROR_RATE, config.BREAKER_SLOW_CALL,
+                                              config.BREAKER_SLOW_RATE, config.BREAKER_OPEN_SECONDS, config.BREAKER_PROBES)
+    return _api_breaker
+
+_api_cache = None
+_api_cache_lock = threading.Lock()
+_api_flights = SingleFlight()
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def get_api_cache():
+    global _api_cache
+    if _api_cache is None:
+        with _api_cache_lock:
+            if _api_cache is None:
+                _api_cache = TTLCache(config.API_CACHE_MAX_ENTRIES)
+    return _api_cache
+
+def api_cache_key(action: str, params: dict = None):
+    items = []
+    for name, value in sorted((params or {}).items()):
+        if name == 'query':
+            value = normalize_text(str(value))
+        items.append((name, str(value)))
+    return action, tuple(items)
+
+def cache_ttl_for(action, ttl=None):
+    # A command's own cache policy wins over the per-action default
+    return config.CACHE_TTLS.get(action, 0) if ttl is None else ttl
+
+# Feeds every user sees alike; their responses also go to the shared store, so a worker that has not
+# fetched one yet takes it from another instead of going upstream
+SHARED_ACTIONS = {'new_tracks', 'trending_tracks', 'top_artists', 'special_playlist'}
+_shared_cache = None
+_shared_cache_opened = False
+
+def get_shared_cache():
+    global _shared_cache, _shared_cache_opened
+    if not _shared_cache_opened:
+        with _api_cache_lock:
+            if not _shared_cache_opened:
+                _shared_cache = open_shared_cache(config.SHARED_CACHE_URL)
+                _shared_cache_opened = True
+    return _shared_cache
+
+def shared_cache_key(key):
+    return 'api:' + json.dumps(key, ensure_ascii=False)
+
+def load_shared_response(key):
+    # Copies another worker's response into the local cache with the freshness it has left
+    shared = get_shared_cache()
+    entry = shared.get(shared_cache_key(key)) if shared else None
+    if entry is None:
+        return None, False
+    now = time.time()
+    fresh_for = max(0.0, entry['fresh_until'] - now)
+    get_api_cache().set(key, entry['data'], fresh_for, max(0.0, entry['stale_until'] - now - fresh_for))
+    return entry['data'], fresh_for > 0
+
+def lookup_api_cache(key, action, ttl=None, shared=True):
+    # Returns (data, fresh); data is None when the action is uncached or missing. shared=False skips
+    # the shared store, which blocks; the async mode reads it from a thread instead
+    if not cache_ttl_for(action, ttl):
+        return None, False
+    data, fresh = get_api_cache().get(key)
+    if data is None and shared and action in SHARED_ACTIONS:
+        data, fresh = load_shared_response(key)
+    return data, fresh
+
+def store_api_response(key, action, success, data, ttl=None, shared=True):
+    # Returns whether the response was cached; shared=False leaves the shared store to the caller
+    if not success or not data.get('ok'):
+        return False
+    remember_good_response(key, data)
+    ttl = cache_ttl_for(action, ttl)
+    if not ttl:
+        return False
+    get_api_cache().set(key, data, ttl, config.API_CACHE_STALE_TTL)
+    if shared:
+        store_shared_response(key, action, data, ttl)
+    return True
+
+def store_shared_response(key, action, data, ttl):
+    shared = get_shared_cache() if action in SHARED_ACTIONS else None
+    if shared is not None:
+        now = time.time()
+        shared.set(shared_cache_key(key), {'data': data, 'fresh_until': now + ttl, 'stale_until': now + ttl + config.API_CACHE_STALE_TTL},
+                   ttl + config.API_CACHE_STALE_TTL)
+
+# Last good response per key, kept past the cache's stale window and marked 'stale'; answered
+# instead of an error while the upstream is failing or the breaker is open
+_last_good = OrderedDict()
+_last_good_lock = threading.Lock()
+
+def remember_good_response(key, data):
+    with _last_good_lock:
+        _last_good[key] = dict(data, stale=True)
+        _last_good.move_to_end(key)
+        while len(_last_good) > config.API_CACHE_MAX_ENTRIES:
+            _last_good.popitem(last=False)
+
+def last_good_response(key):
+    with _last_good_lock:
+        data = _last_good.get(key)
+    if data is not None:
+        _count_api_stat('degraded')
+    return data
+
+def degrade(key, result):
+    success, data = result
+    if not success:
+        stale = last_good_response(key)
+        if stale is not None:
+            logging.warning(f"Upstream unavailable ({data}), serving last good response for {key[0]}")
+            return True, stale
+    return result
+
+def claim_refresh(key):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+        return True
+
+def release_refresh(key, refreshed):
+    with _refreshing_lock:
+        _refreshing.discard(key)
+    if refreshed:
+        get_api_cache().count('refreshes')
+
+def _fetch_and_store(key, action, params, ttl=None):
+    def fetch():
+        success, data = _fetch_upstream(action, params)
+        store_api_response(key, action, success, data, ttl)
+        return success, data
+
+    if action in COALESCED_ACTIONS:
+        return _api_flights.do(key, fetch)
+    return fetch()
+
+def _refresh_in_background(key, action, params, ttl=None):
+    if not claim_refresh(key):
+        return
+
+    def refresh():
+        success = False
+        try:
+            success, data = _fetch_and_store(key, action, params, ttl)
+        finally:
+            release_refresh(key, success)
+
+    threading.Thread(target=refresh, name=f'cache-refresh-{action}', daemon=True).start()
+
+def safe_api_call(action: str, params: dict = None, ttl: int = None):
+    key = api_cache_key(action, params)
+    data, fresh = lookup_api_cache(key, action, ttl)
+    if data is not None:
+        if not fresh:
+            _refresh_in_background(key, action, params, ttl)
+        return True, data
+    return degrade(key, _fetch_and_store(key, action, params, ttl))
+
 def normalize_query(query: str) -> str:
     if not query:
         return ""
     return re.sub(r'\s+', ' ', query.strip())
 
-def format_music_results(data, query):
-    logging.info(f"Formatting results for query: {query}, data: {data}")
-    if not isinstance(data, dict) or not data.get('ok'):
-        logging.warning(f"No valid results for query: {query}")
-        return f"❌ هیچ نتیجه‌ای برای '{query}' پیدا نشد."
-    
-    result = data.get('result', {})
-    search_result = result.get('search_result', {})
-    musics = search_result.get('musics', {}) if isinstance(search_result, dict) else {}
-    videos = search_result.get('videos', {}) if isinstance(search_result, dict) else {}
-    output = [f"🎵 نتایج جستجو برای '{query}':\n"]
-    count = 0
+# Folds Arabic/Persian letter variants, diacritics, tatweel, ZWNJ, digits and case so that
+# differently typed spellings of a name compare equal
+_TEXT_FOLDS = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه', 'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ؤ': 'و',
+    '\u200c': ' ', '\u200d': '', '\u0640': '',
+    **{chr(0x06F0 + i): str(i) for i in range(10)}, **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+_DIACRITICS = re.compile('[\u064B-\u065F\u0670\u06D6-\u06ED]')
 
-    for music_id, music_data in musics.items():
-        if count >= 10:
-            break
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text or '').translate(_TEXT_FOLDS)
+    return normalize_query(_DIACRITICS.sub('', text)).lower()
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# In-process index of artist and track names seen in upstream responses. Trigrams give fuzzy
+# "did you mean" suggestions, and a JSON snapshot on disk keeps it warm across restarts.
+class SearchIndex:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = {}     # normalized name -> [display name, kind, times seen]
+        self._trigrams = {}    # trigram -> set of normalized names
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _insert(self, key, name, kind, seen):
+        self._entries[key] = [name, kind, seen]
+        for gram in _trigrams(key):
+            self._trigrams.setdefault(gram, set()).add(key)
+
+    def add(self, name, kind):
+        key = normalize_text(name)
+        if len(key) < 2 or key == normalize_text('نامشخص'):
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[2] += 1
+            elif len(self._entries) < self.max_entries:
+                self._insert(key, name, kind, 1)
+            else:
+                return
+            self._dirty = True
+
+    def suggest(self, query, limit=3, min_score=0.3):
+        key = normalize_text(query)
+        grams = _trigrams(key)
+        with self._lock:
+            shared = {}
+            for gram in grams:
+                for candidate in self._trigrams.get(gram, ()):
+                    shared[candidate] = shared.get(candidate, 0) + 1
+            scored = []
+            for candidate, common in shared.items():
+                if candidate == key:
+                    continue
+                score = common / (len(grams) + len(_trigrams(candidate)) - common)
+                if score >= min_score:
+                    entry = self._entries[candidate]
+                    scored.append((score, entry[2], entry[0]))
+        scored.sort(reverse=True)
+        return [name for score, seen, name in scored[:limit]]
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not load search index snapshot: {e}")
+            return
+        with self._lock:
+            for name, kind, seen in snapshot.get('entries', [])[:self.max_entries]:
+                key = normalize_text(name)
+                if key not in self._entries:
+                    self._insert(key, name, kind, seen)
+        logging.info(f"Loaded {len(self._entries)} search index entries from {self.path}")
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = list(self._entries.values())
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'entries': entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Could not save search index snapshot: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def save_if_due(self):
+        if self._dirty and time.monotonic() - self._saved_at >= config.SEARCH_INDEX_SAVE_INTERVAL:
+            self._saved_at = time.monotonic()
+            threading.Thread(target=self.save, name='search-index-save', daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'trigrams': len(self._trigrams), 'max_entries': self.max_entries}
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+def get_search_index():
+    global _search_index
+    if _search_index is None:
+        with _search_index_lock:
+            if _search_index is None:
+                index = SearchIndex(config.SEARCH_INDEX_PATH, config.SEARCH_INDEX_MAX_ENTRIES)
+                index.load()
+                atexit.register(index.save)
+                _search_index = index
+    return _search_index
+
+def has_search_results(data):
+    search_result = data.get('result', {}).get('search_result', {}) if isinstance(data, dict) else {}
+    return isinstance(search_result, dict) and bool(search_result.get('musics') or search_result.get('videos'))
+
+RESULTS_LIMIT = 10
+
+def _localized(value):
+    return value.get('fa') or value.get('en') if isinstance(value, dict) else str(value)
+
+# Normalized views of upstream items. The bot's text, inline answers, /api/search and the webapp
+# all render from these instead of digging through the nested upstream dicts.
+class Track:
+    __slots__ = ('id', 'title', 'artist', 'song', 'audio_url', 'share_link')
+    kind = 'music'
+
+    def __init__(self, id, title, artist, song, audio_url, share_link):
+        self.id = id
+        self.title = title
+        self.artist = artist
+        self.song = song
+        self.audio_url = audio_url
+        self.share_link = share_link
+
+    def to_dict(self):
+        return {'id': self.id, 'title': self.title, 'artist': self.artist, 'song': self.song,
+                'audio_url': self.audio_url, 'share_link': self.share_link}
+
+class Video:
+    __slots__ = ('id', 'title', 'artist', 'share_link')
+    kind = 'video'
+
+    def __init__(self, id, title, artist, share_link):
+        self.id = id
+        self.title = title
+        self.artist = artist
+        self.share_link = share_link
+
+    def to_dict(self):
+        return {'id': self.id, 'title': self.title, 'artist': self.artist, 'share_link': self.share_link}
+
+class Artist:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+class Playlist:
+    __slots__ = ('title',)
+
+    def __init__(self, title):
+        self.title = title
+
+def iter_search_records(data):
+    # Builds one record per item on demand, so callers that stop early never touch the rest
+    search_result = data.get('result', {}).get('search_result', {}) if isinstance(data, dict) else {}
+    if not isinstance(search_result, dict):
+        return
+    musics = search_result.get('musics') or {}
+    for music_id, music_data in (musics.items() if isinstance(musics, dict) else ()):
         if not isinstance(music_data, dict):
-            logging.warning(f"Invalid music data format: {music_data}")
+            logging.warning(f"Invalid music data format for item {music_id}")
             continue
-        title = music_data.get('title', 'نامشخص')
-        artist_name = music_data.get('artist_name', {})
-        song_name = music_data.get('song_name', {})
-        share_link = music_data.get('share_link', '')
-        audio_url = music_data.get('audio_url', '')
-        artist = artist_name.get('fa') or artist_name.get('en') if isinstance(artist_name, dict) else str(artist_name)
-        song = song_name.get('fa') or song_name.get('en') if isinstance(song_name, dict) else str(song_name)
-        result_text = f"🎵 {title}\n👤 آرتیست: {artist}\n"
-        if song:
-            result_text += f"🎼 آهنگ: {song}\n"
-        if audio_url:
-            result_text += f"🎧 پخش: {audio_url}\n"
-        if share_link:
-            result_text += f"⬇️ دانلود: {share_link}\n"
-        output.append(result_text)
-        count += 1
-
-    for video_id, video_data in videos.items():
-        if count >= 10:
-            break
+        yield Track(music_id, music_data.get('title', 'نامشخص'), _localized(music_data.get('artist_name', {})),
+                    _localized(music_data.get('song_name', {})), music_data.get('audio_url', ''), music_data.get('share_link', ''))
+    videos = search_result.get('videos') or {}
+    for video_id, video_data in (videos.items() if isinstance(videos, dict) else ()):
         if not isinstance(video_data, dict):
-            logging.warning(f"Invalid video data format: {video_data}")
+            logging.warning(f"Invalid video data format for item {video_id}")
             continue
-        title = video_data.get('title', 'نامشخص')
-        artist_name = video_data.get('artist_name', {})
-        share_link = video_data.get('share_link', '')
-        artist = artist_name.get('fa') or artist_name.get('en') if isinstance(artist_name, dict) else str(artist_name)
-        result_text = f"🎬 {title}\n👤 آرتیست: {artist}\n"
-        if share_link:
-            result_text += f"⬇️ دانلود: {share_link}\n"
-        output.append(result_text)
-        count += 1
+        yield Video(video_id, video_data.get('title', 'نامشخص'), _localized(video_data.get('artist_name', {})),
+                    video_data.get('share_link', ''))
+
+# Built at most once per upstream response object and memoized next to it, so every consumer of a
+# (usually cached) response shares one parse
+class ParsedResponse:
+    __slots__ = ('data', '_records', '_records_limit', '_artists', '_playlists', '_search_asset', '_lock')
+
+    def __init__(self, data):
+        self.data = data
+        self._records = []
+        self._records_limit = 0
+        self._artists = None
+        self._playlists = None
+        self._search_asset = None
+        self._lock = threading.Lock()
+
+    def records(self, limit):
+        with self._lock:
+            if limit > self._records_limit:
+                self._records = list(itertools.islice(iter_search_records(self.data), limit))
+                self._records_limit = limit
+            return self._records[:limit]
+
+    def artists(self):
+        if self._artists is None:
+            artists = self.data.get('result', {}).get('artists', [])
+            self._artists = [Artist(a.get('name', 'نامشخص')) for a in artists if isinstance(a, dict)]
+        return self._artists
+
+    def playlists(self):
+        if self._playlists is None:
+            playlist = self.data.get('result', {}).get('playlist', [])
+            self._playlists = [Playlist(p.get('title', 'نامشخص')) for p in playlist if isinstance(p, dict)]
+        return self._playlists
+
+    def search_payload(self):
+        records = self.records(config.API_SEARCH_RESULTS)
+        return {
+            'ok': bool(self.data.get('ok')),
+            'stale': bool(self.data.get('stale')),
+            'tracks': [r.to_dict() for r in records if r.kind == 'music'],
+            'videos': [r.to_dict() for r in records if r.kind == 'video'],
+        }
+
+    def search_asset(self):
+        # Trimmed /api/search body, serialized and compressed once per response
+        if self._search_asset is None:
+            self._search_asset = json_asset(self.search_payload())
+        return self._search_asset
+
+_parsed_responses = OrderedDict()
+_parsed_responses_lock = threading.Lock()
+
+def get_parsed_response(data):
+    key = id(data)
+    with _parsed_responses_lock:
+        parsed = _parsed_responses.get(key)
+        if parsed is None or parsed.data is not data:
+            parsed = _parsed_responses[key] = ParsedResponse(data)
+            while len(_parsed_responses) > 256:
+                _parsed_responses.popitem(last=False)
+        _parsed_responses.move_to_end(key)
+    return parsed
+
+def parse_search_results(data, limit=None):
+    return get_parsed_response(data).records(limit or max(RESULTS_LIMIT, config.MAX_AUDIO_PER_SEARCH))
 
+def format_record(record, index):
+    index.add(record.artist, 'artist')
+    if record.kind == 'music':
+        index.add(record.song or record.title, 'track')
+        result_text = f"🎵 {record.title}\n👤 آرتیست: {record.artist}\n"
+        if record.song:
+            result_text += f"🎼 آهنگ: {record.song}\n"
+        if record.audio_url:
+            result_text += f"🎧 پخش: {record.audio_url}\n"
+    else:
+        result_text = f"🎬 {record.title}\n👤 آرتیست: {record.artist}\n"
+    if record.share_link:
+        result_text += f"⬇️ دانلود: {record.share_link}\n"
+    return result_text
+
+def page_count(records):
+    return max(1, math.ceil(len(records) / config.SEARCH_PAGE_SIZE))
+
+def format_results_page(query, records, page):
+    index = get_search_index()
+    start = page * config.SEARCH_PAGE_SIZE
+    output = [f"🎵 نتایج جستجو برای '{query}' (صفحه {page + 1} از {page_count(records)}):\n"]
+    output.extend(format_record(record, index) for record in records[start:start + config.SEARCH_PAGE_SIZE])
+    index.save_if_due()
+    return '\n'.join(output)
+
+def format_music_results(data, query):
+    logging.debug("Formatting results for query: %s", query, extra=SAMPLED)
+    if not isinstance(data, dict) or not data.get('ok'):
+        logging.warning(f"No valid results for query: {query}")
+        return f"❌ هیچ نتیجه‌ای برای '{query}' پیدا نشد."
+
+    output = [f"🎵 نتایج جستجو برای '{query}':\n"]
+    index = get_search_index()
+    output.extend(format_record(record, index) for record in parse_search_results(data)[:RESULTS_LIMIT])
+    index.save_if_due()
     if len(output) == 1:
-        logging.info(f"No results found for query: {query}")
+        logging.info("No results found for query: %s", query, extra=SAMPLED)
         return f"❌ هیچ نتیجه‌ای برای '{query}' پیدا نشد.\nپیشنهاد: املای نام را بررسی کنید یا نام دیگری امتحان کنید."
     return '\n'.join(output)
 
+STALE_NOTICE = "⚠️ سرویس موزیک در دسترس نیست؛ آخرین نتایج ذخیره‌شده نمایش داده می‌شود.\n\n"
+
+def with_stale_notice(text, data):
+    return STALE_NOTICE + text if data.get('stale') else text
+
+def edit_telegram_message(chat_id, message_id, text, reply_markup=None):
+    try:
+        with telegram_call('edit_message_text'):
+            get_bot().edit_message_text(text, chat_id, message_id, parse_mode='HTML', reply_markup=reply_markup)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to edit message {message_id} in chat {chat_id}: {e}")
+        return False
+
 def send_telegram_message(chat_id, text, reply_markup=None):
     try:
-        bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=reply_markup)
-        logging.info(f"Sent message to chat {chat_id}: {text[:50]}...")
+        with telegram_call('send_message'):
+            get_bot().send_message(chat_id, text, parse_mode='HTML', reply_markup=reply_markup)
+        logging.info("Sent message to chat %s: %.50s...", chat_id, text, extra=SAMPLED)
         return True
     except Exception as e:
         logging.error(f"Failed to send Telegram message: {e}")
         return False
 
-def send_main_keyboard(chat_id):
+def build_main_keyboard():
     keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     keyboard.row("🔍 جستجو موزیک", "🎵 آهنگ جدید")
     keyboard.row("⭐ خواننده محبوب", "🎶 پلی‌لیست ویژه")
     keyboard.row("⬇️ دانلود آهنگ", "🎧 پخش آهنگ")
     keyboard.row("📈 موزیک ترند", "❓ راهنما")
     keyboard.row("🚀 پیشنهاد تصادفی", "🎤 موزیک هنرمند")
-    send_telegram_message(chat_id, "لطفاً گزینه مورد نظر را انتخاب کنید:", reply_markup=keyboard)
+    keyboard.row("🔔 اشتراک‌های من")
+    return keyboard
+
+def send_main_keyboard(chat_id):
+    send_telegram_message(chat_id, MAIN_KEYBOARD_PROMPT, reply_markup=build_main_keyboard())
+
+WELCOME_TEXT = "🎵 به BehimeloBot خوش آمدید!\nامکانات:\n- جستجو موزیک\n- آهنگ جدید\n- خواننده محبوب\n- پلی‌لیست ویژه\n- دانلود و پخش موزیک\n- موزیک ترند\n- راهنما\n- پیشنهاد تصادفی\n- موزیک هنرمند\n- اطلاع از آهنگ‌های جدید هنرمندان"
+MAIN_KEYBOARD_PROMPT = "لطفاً گزینه مورد نظر را انتخاب کنید:"
+
+def format_top_artists(data):
+    artists = get_parsed_response(data).artists()
+    return "⭐ لیست خواننده‌های محبوب:\n" + "\n".join([f"{i+1}. {a.name}" for i, a in enumerate(artists)])
+
+def format_special_playlist(data):
+    playlist = get_parsed_response(data).playlists()
+    return "🎶 پلی‌لیست ویژه:\n" + "\n".join([f"{i+1}. {p.title}" for i, p in enumerate(playlist)])
+
+# Blocking token bucket; pause() holds it closed, e.g. for a Telegram retry_after
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def reserve(self):
+        # Takes a token and returns 0.0, or returns the seconds to wait before trying again
+        with self._lock:
+            return self._wait_time(time.monotonic())
 
-def handle_search_command(message_text, chat_id):
-    query = normalize_query(message_text)
+    def try_acquire(self):
+        return self.reserve() == 0.0
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.reserve()
+            if wait == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+_chat_buckets = OrderedDict()
+_chat_buckets_lock = threading.Lock()
+_global_bucket = None
+_audio_executor = None
+_audio_executor_pid = None
+_audio_executor_lock = threading.Lock()
+_audio_stats_lock = threading.Lock()
+audio_stats = {'sent': 0, 'failed': 0, 'throttled': 0, 'skipped': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+def get_chat_bucket(chat_id):
+    with _chat_buckets_lock:
+        bucket = _chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _chat_buckets[chat_id] = TokenBucket(config.TELEGRAM_CHAT_RATE, config.TELEGRAM_CHAT_BURST)
+            while len(_chat_buckets) > 10000:
+                _chat_buckets.popitem(last=False)
+        else:
+            _chat_buckets.move_to_end(chat_id)
+        return bucket
+
+def get_global_bucket():
+    global _global_bucket
+    if _global_bucket is None:
+        with _chat_buckets_lock:
+            if _global_bucket is None:
+                _global_bucket = TokenBucket(config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_GLOBAL_RATE)
+    return _global_bucket
+
+def get_audio_executor():
+    global _audio_executor, _audio_executor_pid
+    pid = os.getpid()
+    if _audio_executor is None or _audio_executor_pid != pid:
+        with _audio_executor_lock:
+            if _audio_executor is None or _audio_executor_pid != pid:
+                _audio_executor = ThreadPoolExecutor(max_workers=config.AUDIO_SEND_WORKERS, thread_name_prefix='audio-send')
+                _audio_executor_pid = pid
+    return _audio_executor
+
+# Paces audio sends per chat without parking threads: a send goes to the audio pool only once its
+# chat's bucket has a token, so a chat waiting on its bucket holds no thread and a search returns as
+# soon as its audios are queued. Sends of one chat start in order.
+class AudioScheduler:
+    def __init__(self, executor):
+        self.executor = executor
+        self._queues = {}  # chat_id -> deque of (audio_url, caption, context) not started yet
+        self._due = []  # heap of (when, seq, chat_id); a chat with queued sends is in it exactly once
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name='audio-scheduler', daemon=True).start()
+
+    def enqueue(self, chat_id, items):
+        if not items:
+            return
+        with self._cond:
+            pending = self._queues.get(chat_id)
+            if pending is not None:
+                pending.extend(items)
+                return
+            self._queues[chat_id] = deque(items)
+            heapq.heappush(self._due, (time.monotonic(), next(self._seq), chat_id))
+            self._cond.notify()
+
+    def queued(self):
+        with self._cond:
+            return sum(len(items) for items in self._queues.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._cond.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, _, chat_id = heapq.heappop(self._due)
+                wait = get_chat_bucket(chat_id).reserve()
+                if wait:
+                    heapq.heappush(self._due, (time.monotonic() + wait, next(self._seq), chat_id))
+                    continue
+                pending = self._queues[chat_id]
+                audio_url, caption, context = pending.popleft()
+                if pending:
+                    heapq.heappush(self._due, (time.monotonic(), next(self._seq), chat_id))
+                else:
+                    del self._queues[chat_id]
+            self.executor.submit(context.run, send_audio_limited, chat_id, audio_url, caption, reserved=True)
+
+_audio_scheduler = None
+_audio_scheduler_pid = None
+_audio_scheduler_lock = threading.Lock()
+
+def get_audio_scheduler():
+    global _audio_scheduler, _audio_scheduler_pid
+    pid = os.getpid()
+    if _audio_scheduler is None or _audio_scheduler_pid != pid:
+        with _audio_scheduler_lock:
+            if _audio_scheduler is None or _audio_scheduler_pid != pid:
+                _audio_scheduler = AudioScheduler(get_audio_executor())
+                _audio_scheduler_pid = pid
+    return _audio_scheduler
+
+def _count_audio_stat(name, latency=None):
+    with _audio_stats_lock:
+        audio_stats[name] += 1
+        if latency is not None:
+            audio_stats['latency_total'] += latency
+            audio_stats['latency_max'] = max(audio_stats['latency_max'], latency)
+
+def get_audio_stats():
+    with _audio_stats_lock:
+        stats = dict(audio_stats)
+    stats['latency_avg'] = stats['latency_total'] / stats['sent'] if stats['sent'] else 0.0
+    stats['max_per_search'] = config.MAX_AUDIO_PER_SEARCH
+    stats['queued'] = _audio_scheduler.queued() if _audio_scheduler and _audio_scheduler_pid == os.getpid() else 0
+    return stats
+
+# telebot's sync and asyncio clients raise different ApiTelegramException classes
+def retry_after_seconds(error):
+    if getattr(error, 'error_code', None) == 429:
+        parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+        return parameters.get('retry_after', 1)
+    return None
+
+# Persistent audio_url -> Telegram file_id map so popular tracks are re-sent without a re-upload.
+# Database errors only turn lookups into misses; they never block delivery.
+class FileIdCache:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._stores = 0
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0, 'errors': 0}
+
+    def _connection(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS audio_file_ids (track_key TEXT PRIMARY KEY, file_id TEXT NOT NULL, last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS audio_file_ids_last_used ON audio_file_ids (last_used)')
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            try:
+                conn = self._connection()
+                row = conn.execute('SELECT file_id FROM audio_file_ids WHERE track_key = ?', (key,)).fetchone()
+                if row is None:
+                    self._stats['misses'] += 1
+                    return None
+                conn.execute('UPDATE audio_file_ids SET last_used = ? WHERE track_key = ?', (time.time(), key))
+                conn.commit()
+                self._stats['hits'] += 1
+                return row[0]
+            except sqlite3.Error as e:
+                logging.error(f"file_id cache lookup failed: {e}")
+                self._stats['errors'] += 1
+                return None
+
+    def set(self, key, file_id):
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute('INSERT OR REPLACE INTO audio_file_ids (track_key, file_id, last_used) VALUES (?, ?, ?)', (key, file_id, time.time()))
+                self._stats['stores'] += 1
+                self._stores += 1
+                # Trimming is amortized over many stores; the table may briefly exceed its bound
+                if self._stores % 100 == 1:
+                    excess = conn.execute('SELECT COUNT(*) FROM audio_file_ids').fetchone()[0] - self.max_entries
+                    if excess > 0:
+                        conn.execute('DELETE FROM audio_file_ids WHERE track_key IN (SELECT track_key FROM audio_file_ids ORDER BY last_used LIMIT ?)', (excess,))
+                        self._stats['evictions'] += excess
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"file_id cache store failed: {e}")
+                self._stats['errors'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute('DELETE FROM audio_file_ids WHERE track_key = ?', (key,))
+                conn.commit()
+                self._stats['invalidations'] += 1
+            except sqlite3.Error as e:
+                logging.error(f"file_id cache invalidation failed: {e}")
+                self._stats['errors'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['max_entries'] = self.max_entries
+        return stats
+
+_file_id_cache = None
+
+def get_file_id_cache():
+    global _file_id_cache
+    if _file_id_cache is None:
+        with _audio_executor_lock:
+            if _file_id_cache is None:
+                _file_id_cache = FileIdCache(config.FILE_ID_DB_PATH, config.FILE_ID_CACHE_SIZE)
+    return _file_id_cache
+
+# Subscription keys an artist name satisfies: the whole folded name, its first and last words and the
+# two together, so "شادمهر" or "aghili" match "شادمهر عقیلی" / "Shadmehr Aghili" while a middle name
+# or part of a word does not
+def artist_match_keys(name):
+    words = normalize_text(name).split()
+    if len(words) < 2:
+        return set(words)
+    return {' '.join(words), words[0], words[-1], f"{words[0]} {words[-1]}"}
+
+# Artist subscriptions per chat, keyed by the folded artist name; the release notifier
+# (behimelobot_notify) reads them from the same database
+class SubscriptionStore:
+    def __init__(self, path, max_per_chat):
+        self.path = path
+        self.max_per_chat = max_per_chat
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._stats = {'added': 0, 'removed': 0, 'errors': 0}
+
+    def _connection(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS subscriptions (chat_id INTEGER NOT NULL, artist_key TEXT NOT NULL, '
+                         'artist TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (chat_id, artist_key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS subscriptions_artist ON subscriptions (artist_key)')
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def add(self, chat_id, artist):
+        # Returns 'added', 'exists', 'full' or 'error'
+        with self._lock:
+            try:
+                conn = self._connection()
+                key = normalize_text(artist)
+                if conn.execute('SELECT 1 FROM subscriptions WHERE chat_id = ? AND artist_key = ?', (chat_id, key)).fetchone():
+                    return 'exists'
+                if conn.execute('SELECT COUNT(*) FROM subscriptions WHERE chat_id = ?', (chat_id,)).fetchone()[0] >= self.max_per_chat:
+                    return 'full'
+                conn.execute('INSERT INTO subscriptions (chat_id, artist_key, artist, created) VALUES (?, ?, ?, ?)',
+                             (chat_id, key, artist, time.time()))
+                conn.commit()
+                self._stats['added'] += 1
+                return 'added'
+            except sqlite3.Error as e:
+                logging.error(f"Subscription store failed: {e}")
+                self._stats['errors'] += 1
+                return 'error'
+
+    def remove(self, chat_id, artist=None):
+        # Removes one artist, or every subscription of the chat; returns how many were removed
+        with self._lock:
+            try:
+                conn = self._connection()
+                if artist is None:
+                    removed = conn.execute('DELETE FROM subscriptions WHERE chat_id = ?', (chat_id,)).rowcount
+                else:
+                    removed = conn.execute('DELETE FROM subscriptions WHERE chat_id = ? AND artist_key = ?',
+                                           (chat_id, normalize_text(artist))).rowcount
+                conn.commit()
+                self._stats['removed'] += removed
+                return removed
+            except sqlite3.Error as e:
+                logging.error(f"Subscription removal failed: {e}")
+                self._stats['errors'] += 1
+                return 0
+
+    def list(self, chat_id):
+        with self._lock:
+            try:
+                rows = self._connection().execute('SELECT artist FROM subscriptions WHERE chat_id = ? ORDER BY created', (chat_id,)).fetchall()
+                return [artist for artist, in rows]
+            except sqlite3.Error as e:
+                logging.error(f"Subscription lookup failed: {e}")
+                self._stats['errors'] += 1
+                return []
+
+    def subscribers(self, artist_keys):
+        # {artist_key: [chat_id, ...]} for the given folded names
+        artist_keys = list(artist_keys)
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            for i in range(0, len(artist_keys), 500):
+                chunk = artist_keys[i:i + 500]
+                rows = conn.execute(f"SELECT artist_key, chat_id FROM subscriptions WHERE artist_key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, chat_id in rows:
+                    found.setdefault(key, []).append(chat_id)
+        return found
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['max_per_chat'] = self.max_per_chat
+        return stats
+
+_subscriptions = None
+
+def get_subscriptions():
+    global _subscriptions
+    if _subscriptions is None:
+        with _audio_executor_lock:
+            if _subscriptions is None:
+                _subscriptions = SubscriptionStore(config.SUBSCRIPTIONS_DB_PATH, config.MAX_SUBSCRIPTIONS_PER_CHAT)
+    return _subscriptions
+
+def is_bad_file_id(error):
+    return getattr(error, 'error_code', None) == 400
+
+def send_audio_limited(chat_id, audio_url, caption='', raise_errors=False, reserved=False):
+    # reserved: the caller already took this send's token from the chat's bucket
+    chat_bucket = get_chat_bucket(chat_id)
+    file_ids = get_file_id_cache()
+    file_id = file_ids.get(audio_url)
+    retries = 0
+    while True:
+        if not reserved:
+            chat_bucket.acquire()
+        reserved = False
+        get_global_bucket().acquire()
+        started = time.monotonic()
+        try:
+            with telegram_call('send_audio'):
+                message = get_bot().send_audio(chat_id, file_id or audio_url, caption=caption)
+            latency = time.monotonic() - started
+            _count_audio_stat('sent', latency)
+            if file_id is None and getattr(message, 'audio', None) is not None:
+                file_ids.set(audio_url, message.audio.file_id)
+            logging.info("Sent audio to chat %s in %.2fs (%s): %s", chat_id, latency, 'cached' if file_id else 'upload', caption, extra=SAMPLED)
+            return True
+        except Exception as e:
+            if file_id is not None and is_bad_file_id(e):
+                logging.warning(f"Cached file_id rejected for {audio_url}, re-sending by URL")
+                file_ids.invalidate(audio_url)
+                file_id = None
+                continue
+            retry_after = retry_after_seconds(e)
+            if retry_after is None or retries == config.AUDIO_SEND_RETRIES:
+                logging.error(f"Failed to send audio to chat {chat_id}: {e}")
+                _count_audio_stat('failed')
+                if raise_errors:
+                    raise
+                return False
+            retries += 1
+            _count_audio_stat('throttled')
+            logging.warning(f"Telegram flood limit for chat {chat_id}, retrying after {retry_after}s")
+            chat_bucket.pause(retry_after)
+
+def select_audio_tracks(records):
+    tracks = [r for r in records if r.kind == 'music' and r.audio_url]
+    if len(tracks) > config.MAX_AUDIO_PER_SEARCH:
+        with _audio_stats_lock:
+            audio_stats['skipped'] += len(tracks) - config.MAX_AUDIO_PER_SEARCH
+        tracks = tracks[:config.MAX_AUDIO_PER_SEARCH]
+    return tracks
+
+def deliver_audios(chat_id, tracks):
+    # Queues the sends and returns their count without waiting for them, so an update worker is not
+    # held while the chat's bucket paces them. Each send runs in a copy of this context so its log
+    # lines keep the update's ids
+    get_audio_scheduler().enqueue(chat_id, [(t.audio_url, t.title, contextvars.copy_context()) for t in tracks])
+    return len(tracks)
+
+# Command handlers are generators that yield the I/O they need (effects below) and receive its
+# result back, so the Flask worker pool and the asyncio server (behimelobot_async) run the same code.
+SendMessage = namedtuple('SendMessage', 'chat_id text reply_markup', defaults=(None,))
+EditMessage = namedtuple('EditMessage', 'chat_id message_id text reply_markup', defaults=(None,))
+ApiCall = namedtuple('ApiCall', 'action params ttl', defaults=(None, None))
+SendAudios = namedtuple('SendAudios', 'chat_id tracks')
+AnswerCallback = namedtuple('AnswerCallback', 'callback_query_id text', defaults=(None,))
+AnswerInline = namedtuple('AnswerInline', 'inline_query_id tracks cache_time')
+CachedFeed = namedtuple('CachedFeed', 'name')  # a feed command's pre-rendered reply, or None
+SubscriptionOp = namedtuple('SubscriptionOp', 'op chat_id artist', defaults=(None,))  # op: add, remove or list
+
+class Command:
+    __slots__ = ('name', 'action', 'cache_ttl', 'formatter', 'reply', 'error_prefix', 'handler', 'rate_limit', 'prefetch')
+
+    def __init__(self, name, action=None, cache_ttl=None, formatter=None, reply=None, error_prefix=None, handler=None, rate_limit=None,
+                 prefetch=False):
+        self.name = name
+        self.action = action
+        self.cache_ttl = cache_ttl
+        self.formatter = formatter
+        self.reply = reply
+        self.error_prefix = error_prefix
+        self.handler = handler or (action_handler if action else reply_handler)
+        self.rate_limit = rate_limit
+        self.prefetch = prefetch
+
+class CommandContext:
+    __slots__ = ('update', 'chat_id', 'text', 'query', 'user_id', 'message_id', 'callback_query_id', 'callback_data', 'inline_query_id')
+
+    def __init__(self, update, chat_id=None, text='', query='', user_id=None, message_id=None,
+                 callback_query_id=None, callback_data=None, inline_query_id=None):
+        self.update = update
+        self.chat_id = chat_id
+        self.text = text
+        self.query = query
+        self.user_id = user_id
+        self.message_id = message_id
+        self.callback_query_id = callback_query_id
+        self.callback_data = callback_data
+        self.inline_query_id = inline_query_id
+
+COMMANDS = {}
+TEXT_ROUTES = {}       # button label or /command -> Command
+CALLBACK_ROUTES = {}   # callback_data prefix (before ':') -> Command
+UPDATE_ROUTES = {}     # update kind ('message', 'callback_query', 'inline_query') -> fallback Command
+_command_stats_lock = threading.Lock()
+command_stats = {}
+
+def register_command(name, labels=(), callback_prefix=None, fallback_for=None, **spec):
+    command = Command(name, **spec)
+    COMMANDS[name] = command
+    for label in labels:
+        TEXT_ROUTES[label] = command
+    if callback_prefix:
+        CALLBACK_ROUTES[callback_prefix] = command
+    if fallback_for:
+        UPDATE_ROUTES[fallback_for] = command
+    return command
+
+def reply_handler(command, ctx):
+    yield SendMessage(ctx.chat_id, command.reply)
+
+def action_handler(command, ctx):
+    if command.prefetch:
+        # Fetched and rendered ahead of time by the prefetch leader (behimelobot_prefetch)
+        text = yield CachedFeed(command.name)
+        if text is not None:
+            yield SendMessage(ctx.chat_id, text)
+            return
+    success, data = yield ApiCall(command.action, None, command.cache_ttl)
+    if success:
+        yield SendMessage(ctx.chat_id, with_stale_notice(command.formatter(data, ctx.query), data))
+    else:
+        yield SendMessage(ctx.chat_id, f"{command.error_prefix}: {data}")
+
+def start_handler(command, ctx):
+    yield SendMessage(ctx.chat_id, WELCOME_TEXT)
+    yield SendMessage(ctx.chat_id, MAIN_KEYBOARD_PROMPT, build_main_keyboard())
+
+def search_handler(command, ctx):
+    query = normalize_query(ctx.query)
     if not query:
-        send_telegram_message(chat_id, "❌ لطفاً نام آهنگ یا خواننده را وارد کنید.")
+        yield SendMessage(ctx.chat_id, "❌ لطفاً نام آهنگ یا خواننده را وارد کنید.")
         return
-    send_telegram_message(chat_id, f"🔍 در حال جستجو برای '{query}'...")
-    success, data = safe_api_call('search', {'query': query})
+    yield SendMessage(ctx.chat_id, f"🔍 در حال جستجو برای '{query}'...")
+    success, data = yield ApiCall(command.action, {'query': query}, command.cache_ttl)
     if not success:
-        send_telegram_message(chat_id, f"❌ خطا در جستجو: {data}")
+        yield SendMessage(ctx.chat_id, f"{command.error_prefix}: {data}")
         return
-    formatted = format_music_results(data, query)
-    send_telegram_message(chat_id, formatted)
-    
+    remember_search(query, data)
+    records = parse_search_results(data, config.SEARCH_MAX_RESULTS)
+    if len(records) > config.SEARCH_PAGE_SIZE:
+        token = store_result_pages(query, records, data.get('stale', False))
+        text, keyboard = format_results_page(query, records, 0), results_keyboard(token, 0, records)
+    else:
+        text, keyboard = command.formatter(data, query), suggestion_keyboard(query, data) or subscribe_keyboard(records)
+    yield SendMessage(ctx.chat_id, with_stale_notice(text, data), keyboard)
+
     # Send audio if available
-    search_result = data.get('result', {}).get('search_result', {})
-    musics = search_result.get('musics', {}) if isinstance(search_result, dict) else {}
-    for music_id, music_data in musics.items():
-        audio_url = music_data.get('audio_url')
-        title = music_data.get('title', '')
-        if audio_url:
+    yield SendAudios(ctx.chat_id, select_audio_tracks(parse_search_results(data)))
+
+def suggestion_keyboard(query, data):
+    if has_search_results(data):
+        return None
+    buttons = []
+    for name in get_search_index().suggest(query):
+        callback_data = f"dym:{name}"
+        # Telegram caps callback_data at 64 bytes
+        if len(callback_data.encode('utf-8')) <= 64:
+            buttons.append(telebot.types.InlineKeyboardButton(f"🤔 منظورتان «{name}» است؟", callback_data=callback_data))
+    if not buttons:
+        return None
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    for button in buttons:
+        keyboard.row(button)
+    return keyboard
+
+def did_you_mean_handler(command, ctx):
+    yield AnswerCallback(ctx.callback_query_id)
+    ctx.query = ctx.callback_data.split(':', 1)[1]
+    yield from search_handler(COMMANDS['search'], ctx)
+
+def unknown_callback_handler(command, ctx):
+    # Stops the button's loading spinner for callbacks nothing handles
+    yield AnswerCallback(ctx.callback_query_id)
+
+def subscribe_button(records):
+    # Offers to follow the top result's artist
+    artist = next((r.artist for r in records if r.kind == 'music' and r.artist), None)
+    if not artist or len(f"sub:{artist}".encode('utf-8')) > 64:
+        return None
+    return telebot.types.InlineKeyboardButton(f"🔔 خبرم کن از آهنگ‌های جدید {artist}", callback_data=f"sub:{artist}")
+
+def subscribe_keyboard(records):
+    button = subscribe_button(records)
+    if button is None:
+        return None
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    keyboard.row(button)
+    return keyboard
+
+# Search results past the first page: token -> (query, records, stale). Page buttons carry only
+# "pg:<token>:<page>", well inside Telegram's 64-byte callback_data limit.
+RESULTS_EXPIRED = "⌛ این نتایج منقضی شده‌اند؛ لطفاً دوباره جستجو کنید."
+_result_pages = None
+
+def get_result_pages():
+    global _result_pages
+    if _result_pages is None:
+        with _api_cache_lock:
+            if _result_pages is None:
+                _result_pages = TTLCache(config.RESULT_PAGES_MAX)
+    return _result_pages
+
+def store_result_pages(query, records, stale):
+    token = os.urandom(6).hex()
+    get_result_pages().set(token, (query, records, stale), config.RESULT_PAGES_TTL)
+    return token
+
+def results_keyboard(token, page, records):
+    pages = page_count(records)
+    buttons = []
+    if page > 0:
+        buttons.append(telebot.types.InlineKeyboardButton("◀️ قبلی", callback_data=f"pg:{token}:{page - 1}"))
+    # The page counter only needs its spinner stopped, which the unknown-callback fallback does
+    buttons.append(telebot.types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data='noop'))
+    if page + 1 < pages:
+        buttons.append(telebot.types.InlineKeyboardButton("بعدی ▶️", callback_data=f"pg:{token}:{page + 1}"))
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    keyboard.row(*buttons)
+    follow = subscribe_button(records)
+    if follow is not None:
+        keyboard.row(follow)
+    return keyboard
+
+def result_page_handler(command, ctx):
+    _, _, rest = ctx.callback_data.partition(':')
+    token, _, page = rest.partition(':')
+    entry, _ = get_result_pages().get(token)
+    if entry is None or not page.isdigit():
+        yield AnswerCallback(ctx.callback_query_id, RESULTS_EXPIRED)
+        return
+    query, records, stale = entry
+    page = min(int(page), page_count(records) - 1)
+    yield AnswerCallback(ctx.callback_query_id)
+    text = format_results_page(query, records, page)
+    yield EditMessage(ctx.chat_id, ctx.message_id, STALE_NOTICE + text if stale else text, results_keyboard(token, page, records))
+
+SUBSCRIBE_REPLIES = {
+    'added': "🔔 از این پس آهنگ‌های جدید «{artist}» برایتان ارسال می‌شود.",
+    'exists': "ℹ️ شما از قبل «{artist}» را دنبال می‌کنید.",
+    'full': "❌ حداکثر {limit} هنرمند را می‌توانید دنبال کنید؛ ابتدا با /unsubscribe یکی را حذف کنید.",
+    'error': "❌ خطا در ثبت اشتراک؛ لطفاً دوباره تلاش کنید.",
+}
+
+def subscribe_handler(command, ctx):
+    artist = normalize_query(ctx.callback_data.split(':', 1)[1] if ctx.callback_query_id else ctx.query)
+    if not artist:
+        yield SendMessage(ctx.chat_id, "نام هنرمند را بعد از /subscribe بنویسید؛ مثلاً: /subscribe شادمهر عقیلی")
+        return
+    status = yield SubscriptionOp('add', ctx.chat_id, artist)
+    text = SUBSCRIBE_REPLIES[status].format(artist=artist, limit=config.MAX_SUBSCRIPTIONS_PER_CHAT)
+    if ctx.callback_query_id:
+        yield AnswerCallback(ctx.callback_query_id, text)
+    else:
+        yield SendMessage(ctx.chat_id, text)
+
+def unsubscribe_handler(command, ctx):
+    artist = normalize_query(ctx.query)
+    if not artist:
+        yield SendMessage(ctx.chat_id, "نام هنرمند را بعد از /unsubscribe بنویسید. فهرست اشتراک‌ها: /subscriptions")
+        return
+    removed = yield SubscriptionOp('remove', ctx.chat_id, artist)
+    yield SendMessage(ctx.chat_id, f"🔕 اشتراک «{artist}» لغو شد." if removed else f"ℹ️ «{artist}» در فهرست اشتراک‌های شما نیست.")
+
+def subscriptions_handler(command, ctx):
+    artists = yield SubscriptionOp('list', ctx.chat_id)
+    if not artists:
+        yield SendMessage(ctx.chat_id, "🔔 هنوز هیچ هنرمندی را دنبال نمی‌کنید.\nبرای دنبال کردن: /subscribe نام هنرمند")
+        return
+    lines = "\n".join(f"{i+1}. {artist}" for i, artist in enumerate(artists))
+    yield SendMessage(ctx.chat_id, f"🔔 هنرمندانی که دنبال می‌کنید:\n{lines}\n\nبرای لغو: /unsubscribe نام هنرمند")
+
+# Inline queries arrive on every keystroke: answer from recent searches when possible, otherwise
+# hold the query back INLINE_DEBOUNCE (inline_debounce, as it is received) and only go upstream if
+# the user has not typed anything newer meanwhile.
+_recent_searches = OrderedDict()
+_recent_searches_lock = threading.Lock()
+_inline_latest = OrderedDict()
+_inline_lock = threading.Lock()
+inline_stats = {'queries': 0, 'answered': 0, 'local_hits': 0, 'upstream': 0, 'superseded': 0}
+
+def _count_inline_stat(name):
+    with _inline_lock:
+        inline_stats[name] += 1
+
+def compact_tracks(data):
+    records = parse_search_results(data, max(RESULTS_LIMIT, config.MAX_AUDIO_PER_SEARCH, config.INLINE_MAX_RESULTS))
+    return [r for r in records if r.kind == 'music' and r.audio_url]
+
+def remember_search(query, data):
+    key = normalize_text(query)
+    tracks = compact_tracks(data)
+    with _recent_searches_lock:
+        _recent_searches[key] = tracks
+        _recent_searches.move_to_end(key)
+        while len(_recent_searches) > config.RECENT_SEARCHES_SIZE:
+            _recent_searches.popitem(last=False)
+
+def recent_search_tracks(query):
+    # Exact hit, or the longest remembered prefix filtered down to tracks matching every word
+    key = normalize_text(query)
+    with _recent_searches_lock:
+        tracks = _recent_searches.get(key)
+        if tracks is not None:
+            return tracks
+        for end in range(len(key) - 1, config.INLINE_MIN_QUERY_LENGTH - 1, -1):
+            tracks = _recent_searches.get(key[:end].rstrip())
+            if tracks:
+                break
+        else:
+            return None
+    words = key.split()
+    matches = [t for t in tracks if all(w in normalize_text(f"{t.title} {t.artist}") for w in words)]
+    return matches or None
+
+def _mark_inline_query(user_id, inline_query_id):
+    with _inline_lock:
+        _inline_latest[user_id] = inline_query_id
+        _inline_latest.move_to_end(user_id)
+        while len(_inline_latest) > 10000:
+            _inline_latest.popitem(last=False)
+
+def _inline_superseded(user_id, inline_query_id):
+    with _inline_lock:
+        latest = _inline_latest.get(user_id)
+    return latest is not None and latest != inline_query_id
+
+def inline_debounce(update):
+    # Called when an update is received, before it is queued: marks an inline query as its user's
+    # latest and returns how long to hold it back, 0 when it can be answered locally. Ingestion
+    # waits on a timer (get_delayed_calls), so a held-back query occupies no worker
+    inline_query = update.get('inline_query')
+    if not isinstance(inline_query, dict):
+        return 0.0
+    _mark_inline_query((inline_query.get('from') or {}).get('id'), inline_query.get('id'))
+    query = normalize_query(inline_query.get('query', ''))
+    if len(query) < config.INLINE_MIN_QUERY_LENGTH or recent_search_tracks(query) is not None:
+        return 0.0
+    return config.INLINE_DEBOUNCE
+
+# Runs callables after a delay from a single thread
+class DelayedCalls:
+    def __init__(self):
+        self._due = []  # heap of (when, seq, func, args)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name='delayed-calls', daemon=True).start()
+
+    def call_later(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._due, (time.monotonic() + delay, next(self._seq), func, args))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._cond.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, _, func, args = heapq.heappop(self._due)
             try:
-                bot.send_audio(chat_id, audio_url, caption=title)
-                logging.info(f"Sent audio to chat {chat_id}: {title}")
+                func(*args)
             except Exception as e:
-                logging.error(f"Failed to send audio to chat {chat_id}: {e}")
+                logging.error(f"Delayed call {func.__name__} failed: {e}")
+
+_delayed_calls = None
+_delayed_calls_pid = None
+_delayed_calls_lock = threading.Lock()
+
+def get_delayed_calls():
+    global _delayed_calls, _delayed_calls_pid
+    pid = os.getpid()
+    if _delayed_calls is None or _delayed_calls_pid != pid:
+        with _delayed_calls_lock:
+            if _delayed_calls is None or _delayed_calls_pid != pid:
+                _delayed_calls = DelayedCalls()
+                _delayed_calls_pid = pid
+    return _delayed_calls
+
+def build_inline_results(tracks, file_id_lookup):
+    results = []
+    for track in tracks[:config.INLINE_MAX_RESULTS]:
+        result_id = hashlib.md5(track.audio_url.encode('utf-8')).hexdigest()
+        file_id = file_id_lookup(track.audio_url)
+        if file_id:
+            results.append(telebot.types.InlineQueryResultCachedAudio(result_id, file_id))
+        else:
+            results.append(telebot.types.InlineQueryResultAudio(result_id, track.audio_url, track.title, performer=track.artist))
+    return results
+
+def inline_search_handler(command, ctx):
+    _count_inline_stat('queries')
+    query = normalize_query(ctx.query)
+    if len(query) < config.INLINE_MIN_QUERY_LENGTH:
+        yield AnswerInline(ctx.inline_query_id, [], config.INLINE_CACHE_TIME)
+        return
+    tracks = recent_search_tracks(query)
+    if tracks is not None:
+        _count_inline_stat('local_hits')
+    else:
+        if _inline_superseded(ctx.user_id, ctx.inline_query_id):
+            # Telegram discards answers to outdated queries, so skip the upstream call entirely
+            _count_inline_stat('superseded')
+            return
+        _count_inline_stat('upstream')
+        success, data = yield ApiCall(command.action, {'query': query}, command.cache_ttl)
+        if not success:
+            yield AnswerInline(ctx.inline_query_id, [], 0)
+            return
+        if data.get('stale'):
+            # Degraded answer: show it, but keep Telegram from caching it
+            _count_inline_stat('answered')
+            yield AnswerInline(ctx.inline_query_id, compact_tracks(data), 0)
+            return
+        remember_search(query, data)
+        tracks = compact_tracks(data)
+    _count_inline_stat('answered')
+    yield AnswerInline(ctx.inline_query_id, tracks, config.INLINE_CACHE_TIME)
+
+def get_inline_stats():
+    with _inline_lock:
+        stats = dict(inline_stats)
+    with _recent_searches_lock:
+        stats['recent_searches'] = len(_recent_searches)
+    return stats
+
+register_command('start', labels=('/start',), handler=start_handler)
+register_command('help', labels=('❓ راهنما', '/help'), reply="📖 راهنما: برای جستجو یا استفاده از گزینه‌ها فقط کافیست دکمه مربوطه را لمس کنید!")
+register_command('artist_prompt', labels=('🎤 موزیک هنرمند',), reply="نام هنرمند را وارد کنید تا موزیک‌هایش نمایش داده شود.")
+register_command('play_prompt', labels=('🎧 پخش آهنگ',), reply="نام آهنگ را وارد کنید تا پخش شود.")
+register_command('download_prompt', labels=('⬇️ دانلود آهنگ',), reply="نام آهنگ یا خواننده را وارد کنید تا لینک دانلود نمایش داده شود.")
+register_command('search_prompt', labels=('🔍 جستجو موزیک',), reply="نام آهنگ یا خواننده را وارد کنید:")
+register_command('new_tracks', labels=('🎵 آهنگ جدید', '/new'), action='new_tracks',
+                 formatter=lambda data, query: format_music_results(data, "آهنگ جدید"),
+                 error_prefix="❌ خطا در دریافت آهنگ جدید", prefetch=True)
+register_command('top_artists', labels=('⭐ خواننده محبوب', '/artists'), action='top_artists',
+                 formatter=lambda data, query: format_top_artists(data),
+                 error_prefix="❌ خطا در دریافت خواننده‌های محبوب", prefetch=True)
+register_command('special_playlist', labels=('🎶 پلی‌لیست ویژه', '/playlist'), action='special_playlist',
+                 formatter=lambda data, query: format_special_playlist(data),
+                 error_prefix="❌ خطا در دریافت پلی‌لیست ویژه", prefetch=True)
+register_command('trending_tracks', labels=('📈 موزیک ترند', '/trending'), action='trending_tracks',
+                 formatter=lambda data, query: format_music_results(data, "موزیک ترند"),
+                 error_prefix="❌ خطا در دریافت موزیک‌های ترند", prefetch=True)
+# Uncached upstream calls get tighter per-chat limits: a search also sends up to MAX_AUDIO_PER_SEARCH audios
+register_command('random_track', labels=('🚀 پیشنهاد تصادفی', '/random'), action='random_track', cache_ttl=0,
+                 formatter=lambda data, query: format_music_results(data, "پیشنهاد تصادفی"),
+                 error_prefix="❌ خطا در پیشنهاد موزیک", rate_limit='0.2/3')
+register_command('search', labels=('/search',), fallback_for='message', action='search', handler=search_handler,
+                 formatter=format_music_results, error_prefix="❌ خطا در جستجو", rate_limit='0.2/5')
+register_command('did_you_mean', callback_prefix='dym', handler=did_you_mean_handler, rate_limit='0.2/5')
+register_command('result_page', callback_prefix='pg', handler=result_page_handler)
+register_command('unknown_callback', fallback_for='callback_query', handler=unknown_callback_handler)
+register_command('subscribe', labels=('/subscribe',), callback_prefix='sub', handler=subscribe_handler)
+register_command('unsubscribe', labels=('/unsubscribe',), handler=unsubscribe_handler)
+register_command('subscriptions', labels=('🔔 اشتراک‌های من', '/subscriptions'), handler=subscriptions_handler)
+register_command('inline_search', fallback_for='inline_query', action='search', handler=inline_search_handler, rate_limit='1/20')
+
+def route_update(update):
+    # Returns (command, context), or (None, None) for updates no command handles
+    if 'message' in update:
+        message = update['message']
+        text = message.get('text')
+        if text is None:
+            return None, None
+        ctx = CommandContext(update, chat_id=message['chat']['id'], text=text, query=text,
+                             user_id=(message.get('from') or {}).get('id'), message_id=message.get('message_id'))
+        command = TEXT_ROUTES.get(text)
+        if command is None and text.startswith('/'):
+            head, _, rest = text.partition(' ')
+            command = TEXT_ROUTES.get(head.split('@', 1)[0])
+            if command is not None:
+                ctx.query = rest
+        return command or UPDATE_ROUTES.get('message'), ctx
+    if 'callback_query' in update:
+        callback = update['callback_query']
+        data = callback.get('data') or ''
+        message = callback.get('message') or {}
+        ctx = CommandContext(update, chat_id=(message.get('chat') or {}).get('id'), user_id=callback['from']['id'],
+                             message_id=message.get('message_id'), callback_query_id=callback['id'], callback_data=data)
+        return CALLBACK_ROUTES.get(data.split(':', 1)[0]) or UPDATE_ROUTES.get('callback_query'), ctx
+    if 'inline_query' in update:
+        inline_query = update['inline_query']
+        ctx = CommandContext(update, text=inline_query.get('query', ''), query=inline_query.get('query', ''),
+                             user_id=inline_query['from']['id'], inline_query_id=inline_query['id'])
+        return UPDATE_ROUTES.get('inline_query'), ctx
+    return None, None
+
+def update_chat_key(update):
+    # Updates sharing a key must be handled in order; inline queries have no chat, so use the user
+    message = update.get('message') or update.get('edited_message') or (update.get('callback_query') or {}).get('message')
+    if message and message.get('chat'):
+        return message['chat']['id']
+    for kind in ('callback_query', 'inline_query', 'chosen_inline_result'):
+        if kind in update:
+            return update[kind]['from']['id']
+    return update.get('update_id')
+
+# Admission control: per-chat token buckets for each command, per-IP buckets for /api/search and a
+# cap on pending work per process. A refused update is answered at once ("busy, try again")
+# instead of waiting behind the backlog it would add to.
+RATE_LIMITED_TEXT = "⏳ درخواست‌های شما زیاد است؛ لطفاً چند ثانیه دیگر دوباره تلاش کنید."
+BUSY_TEXT = "🚦 ربات در حال حاضر شلوغ است؛ لطفاً کمی بعد دوباره تلاش کنید."
+
+def parse_rate_limit(value):
+    # "rate/burst" -> (rate, burst), or None when the limit is disabled
+    rate, _, burst = str(value or '0').partition('/')
+    rate = float(rate)
+    if rate <= 0:
+        return None
+    return rate, int(burst) if burst else max(1, int(rate))
+
+class RateLimiter:
+    # Non-blocking token bucket per key (chat or client IP); least recently seen keys are evicted
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+class ConcurrencyLimit:
+    # Counts work in progress and refuses more than `limit` instead of queueing it
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_update_slots = None
+_api_search_slots = None
+_limits_lock = threading.Lock()
+_rejection_notices = OrderedDict()  # chat key -> monotonic time it was last told it was refused
+_admission_stats_lock = threading.Lock()
+admission_stats = {'rate_limited': 0, 'busy': 0, 'notices': 0}
+
+def get_rate_limiter(name, spec):
+    # One limiter per command name (or 'api_search'), built from its spec on first use; None if disabled
+    limiter = _rate_limiters.get(name, False)
+    if limiter is False:
+        with _rate_limiters_lock:
+            limiter = _rate_limiters.get(name, False)
+            if limiter is False:
+                limit = parse_rate_limit(spec)
+                limiter = _rate_limiters[name] = RateLimiter(*limit) if limit else None
+    return limiter
+
+def get_command_limiter(command):
+    return get_rate_limiter(command.name, config.RATE_LIMITS.get(command.name, command.rate_limit or config.RATE_LIMIT_DEFAULT))
+
+def get_update_slots():
+    global _update_slots
+    if _update_slots is None:
+        with _limits_lock:
+            if _update_slots is None:
+                _update_slots = ConcurrencyLimit(config.MAX_PENDING_UPDATES)
+    return _update_slots
+
+def get_api_search_slots():
+    global _api_search_slots
+    if _api_search_slots is None:
+        with _limits_lock:
+            if _api_search_slots is None:
+                _api_search_slots = ConcurrencyLimit(config.API_SEARCH_MAX_IN_FLIGHT)
+    return _api_search_slots
+
+def count_rejection(name, reason):
+    metric_child(REJECTIONS, name, reason).inc()
+    with _admission_stats_lock:
+        admission_stats[reason] += 1
+
+def _should_notify(key):
+    # Tell a refused chat once per RATE_LIMIT_NOTICE_INTERVAL; answering every message of a flood would
+    # only run into Telegram's own limits
+    now = time.monotonic()
+    with _admission_stats_lock:
+        told_at = _rejection_notices.get(key)
+        if told_at is not None and now - told_at < config.RATE_LIMIT_NOTICE_INTERVAL:
+            return False
+        _rejection_notices[key] = now
+        _rejection_notices.move_to_end(key)
+        while len(_rejection_notices) > 10000:
+            _rejection_notices.popitem(last=False)
+        admission_stats['notices'] += 1
+    return True
+
+def rejection_effect(ctx, text):
+    if ctx.inline_query_id:
+        return AnswerInline(ctx.inline_query_id, [], 0)
+    if ctx.callback_query_id:
+        return AnswerCallback(ctx.callback_query_id, text)
+    return SendMessage(ctx.chat_id, text)
+
+def admit_update(update, slots=None):
+    # Returns (admitted, reply). An admitted update holds one of `slots` (when given) until it is
+    # handled; a refused one is answered with the `reply` effect, or dropped silently (reply None)
+    # when its chat was told recently
+    command, ctx = route_update(update)
+    key = update_chat_key(update)
+    if command is not None:
+        limiter = get_command_limiter(command)
+        if limiter is not None and not limiter.allow(key):
+            count_rejection(command.name, 'rate_limited')
+            return False, rejection_effect(ctx, RATE_LIMITED_TEXT) if _should_notify(key) else None
+    if slots is None or slots.try_enter():
+        return True, None
+    count_rejection(command.name if command else 'unrouted', 'busy')
+    return False, rejection_effect(ctx, BUSY_TEXT) if command is not None and _should_notify(key) else None
+
+def webhook_reply(effect):
+    # A refusal as the webhook response body: Telegram performs the call itself, so shedding load
+    # costs no extra request
+    if isinstance(effect, SendMessage):
+        return {'method': 'sendMessage', 'chat_id': effect.chat_id, 'text': effect.text}
+    if isinstance(effect, AnswerCallback):
+        return {'method': 'answerCallbackQuery', 'callback_query_id': effect.callback_query_id, 'text': effect.text}
+    return {'method': 'answerInlineQuery', 'inline_query_id': effect.inline_query_id, 'results': [], 'cache_time': effect.cache_time}
+
+def client_ip(remote_addr, forwarded_for):
+    # The address the outermost of our PROXY_HOPS proxies saw; earlier X-Forwarded-For entries are client-supplied
+    hops = [hop.strip() for hop in (forwarded_for or '').split(',') if hop.strip()]
+    if config.PROXY_HOPS and len(hops) >= config.PROXY_HOPS:
+        return hops[-config.PROXY_HOPS]
+    return remote_addr
+
+def admit_api_search(ip):
+    # Returns None when the call may run (the caller then holds an api_search slot until it finishes),
+    # else (status, error, retry_after)
+    limiter = get_rate_limiter('api_search', config.API_SEARCH_RATE_LIMIT)
+    if limiter is not None and not limiter.allow(ip):
+        count_rejection('api_search', 'rate_limited')
+        return 429, 'Too many requests', max(1, math.ceil(1 / limiter.rate))
+    if not get_api_search_slots().try_enter():
+        count_rejection('api_search', 'busy')
+        return 503, 'busy', 1
+    return None
+
+def get_admission_stats():
+    with _admission_stats_lock:
+        stats = dict(admission_stats)
+    stats['pending_updates'] = _update_slots.active if _update_slots else 0
+    stats['max_pending_updates'] = config.MAX_PENDING_UPDATES
+    stats['api_search_in_flight'] = _api_search_slots.active if _api_search_slots else 0
+    stats['api_search_max_in_flight'] = config.API_SEARCH_MAX_IN_FLIGHT
+    return stats
+
+def record_command(name, latency, failed=False):
+    metric_child(COMMAND_LATENCY, name).observe(latency)
+    if failed:
+        metric_child(COMMAND_ERRORS, name).inc()
+    refresh_stat_gauges()
+    with _command_stats_lock:
+        stats = command_stats.get(name)
+        if stats is None:
+            stats = command_stats[name] = {'count': 0, 'errors': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        stats['count'] += 1
+        stats['errors'] += failed
+        stats['latency_total'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+
+def get_command_stats():
+    with _command_stats_lock:
+        stats = {name: dict(values) for name, values in command_stats.items()}
+    for values in stats.values():
+        values['latency_avg'] = values['latency_total'] / values['count']
+    return stats
+
+def _perform_send(effect):
+    return send_telegram_message(effect.chat_id, effect.text, effect.reply_markup)
+
+def _perform_edit(effect):
+    return edit_telegram_message(effect.chat_id, effect.message_id, effect.text, effect.reply_markup)
+
+def _perform_api_call(effect):
+    return safe_api_call(effect.action, effect.params, effect.ttl)
+
+def _perform_send_audios(effect):
+    return deliver_audios(effect.chat_id, effect.tracks)
+
+def _perform_answer_callback(effect):
+    try:
+        with telegram_call('answer_callback_query'):
+            get_bot().answer_callback_query(effect.callback_query_id, text=effect.text)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to answer callback query: {e}")
+        return False
+
+def _perform_answer_inline(effect):
+    try:
+        results = build_inline_results(effect.tracks, get_file_id_cache().get)
+        with telegram_call('answer_inline_query'):
+            get_bot().answer_inline_query(effect.inline_query_id, results, cache_time=effect.cache_time)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to answer inline query: {e}")
+        return False
+
+def feed_text_key(name):
+    return f"feed:{name}"
+
+def _perform_cached_feed(effect):
+    shared = get_shared_cache()
+    entry = shared.get(feed_text_key(effect.name)) if shared else None
+    return entry['text'] if entry else None
+
+def _perform_subscription_op(effect):
+    store = get_subscriptions()
+    if effect.op == 'list':
+        return store.list(effect.chat_id)
+    return getattr(store, effect.op)(effect.chat_id, effect.artist)
+
+EFFECT_PERFORMERS = {
+    SendMessage: _perform_send,
+    EditMessage: _perform_edit,
+    ApiCall: _perform_api_call,
+    SendAudios: _perform_send_audios,
+    AnswerCallback: _perform_answer_callback,
+    AnswerInline: _perform_answer_inline,
+    SubscriptionOp: _perform_subscription_op,
+    CachedFeed: _perform_cached_feed,
+}
+
+def dispatch_update(update):
+    command, ctx = route_update(update)
+    if command is None:
+        return
+    in_flight = metric_child(IN_FLIGHT, 'updates')
+    in_flight.inc()
+    started = time.monotonic()
+    failed = True
+    try:
+        with log_context(update_id=update.get('update_id'), command=command.name, chat_id=update_chat_key(update)):
+            steps = command.handler(command, ctx)
+            result = None
+            while True:
+                try:
+                    effect = steps.send(result)
+                except StopIteration:
+                    break
+                result = EFFECT_PERFORMERS[type(effect)](effect)
+        failed = False
+    finally:
+        in_flight.dec()
+        record_command(command.name, time.monotonic() - started, failed)
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.monotonic()
+    g.log_token = _log_context.set({'request_id': request.headers.get('X-Request-ID') or os.urandom(6).hex()})
+    metric_child(IN_FLIGHT, 'http').inc()
+
+@app.after_request
+def _record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metric_child(HTTP_LATENCY, route).observe(time.monotonic() - g.request_started)
+    metric_child(HTTP_REQUESTS, route, str(response.status_code)).inc()
+    return response
+
+@app.teardown_request
+def _end_request_metrics(error=None):
+    if 'request_started' in g:
+        metric_child(IN_FLIGHT, 'http').dec()
+        _log_context.reset(g.log_token)
+
+# Webhook updates are acknowledged immediately and handled by a bounded worker pool
+_update_queue = None
+_update_queue_pid = None
+_update_queue_lock = threading.Lock()
+_seen_updates = OrderedDict()
+_seen_updates_lock = threading.Lock()
+_webhook_stats_lock = threading.Lock()
+webhook_stats = {'received': 0, 'processed': 0, 'failed': 0, 'duplicates': 0, 'dropped': 0, 'rejected': 0,
+                 'latency_total': 0.0, 'latency_max': 0.0}
+
+def _is_duplicate_update(update_id, shared=True):
+    # Seen by this process, or (shared) claimed by any worker on the host in the shared store, so a
+    # redelivery that lands on another gunicorn worker is dropped too. The async mode passes
+    # shared=False and calls claim_update from a thread
+    if update_id is None:
+        return False
+    with _seen_updates_lock:
+        if update_id in _seen_updates:
+            return True
+        _seen_updates[update_id] = None
+        while len(_seen_updates) > config.UPDATE_DEDUP_SIZE:
+            _seen_updates.popitem(last=False)
+    return shared and not claim_update(update_id)
+
+def claim_update(update_id):
+    shared = get_shared_cache()
+    return shared is None or shared.claim(f"update:{update_id}", config.UPDATE_DEDUP_TTL)
+
+def _forget_update(update_id):
+    with _seen_updates_lock:
+        _seen_updates.pop(update_id, None)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.delete(f"update:{update_id}")
+
+def _count_webhook_stat(name, value=1):
+    with _webhook_stats_lock:
+        webhook_stats[name] += value
+
+def _update_worker(update_queue):
+    while True:
+        update, enqueued_at = update_queue.get()
+        try:
+            dispatch_update(update)
+            _count_webhook_stat('processed')
+        except Exception as e:
+            logging.error(f"Update {update.get('update_id')} processing error: {e}")
+            _count_webhook_stat('failed')
+        finally:
+            latency = time.monotonic() - enqueued_at
+            with _webhook_stats_lock:
+                webhook_stats['latency_total'] += latency
+                webhook_stats['latency_max'] = max(webhook_stats['latency_max'], latency)
+            get_update_slots().leave()
+            update_queue.task_done()
+
+def get_update_queue():
+    global _update_queue, _update_queue_pid
+    pid = os.getpid()
+    if _update_queue is None or _update_queue_pid != pid:
+        with _update_queue_lock:
+            if _update_queue is None or _update_queue_pid != pid:
+                update_queue = queue.Queue(maxsize=config.WEBHOOK_QUEUE_SIZE)
+                for i in range(config.WEBHOOK_WORKERS):
+                    threading.Thread(target=_update_worker, args=(update_queue,), name=f'update-worker-{i}', daemon=True).start()
+                _update_queue = update_queue
+                _update_queue_pid = pid
+    return _update_queue
+
+def get_webhook_stats():
+    with _webhook_stats_lock:
+        stats = dict(webhook_stats)
+    done = stats['processed'] + stats['failed']
+    stats['latency_avg'] = stats['latency_total'] / done if done else 0.0
+    stats['queue_depth'] = _update_queue.qsize() if _update_queue_pid == os.getpid() else 0
+    stats['queue_size'] = config.WEBHOOK_QUEUE_SIZE
+    stats['workers'] = config.WEBHOOK_WORKERS
+    return stats
+
+def _enqueue_held_update(update, received_at):
+    # A debounced inline query coming due; it was already acknowledged, so a full queue drops it
+    try:
+        get_update_queue().put_nowait((update, received_at))
+    except queue.Full:
+        get_update_slots().leave()
+        _count_webhook_stat('dropped')
+        logging.error(f"Update queue full, dropping inline query {update.get('update_id')}")
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    try:
-        update = request.get_json()
-        if 'message' in update:
-            message = update['message']
-            chat_id = message['chat']['id']
-            if 'text' in message:
-                text = message['text']
-                if text.startswith('/start'):
-                    send_telegram_message(chat_id, "🎵 به BehimeloBot خوش آمدید!\nامکانات:\n- جستجو موزیک\n- آهنگ جدید\n- خواننده محبوب\n- پلی‌لیست ویژه\n- دانلود و پخش موزیک\n- موزیک ترند\n- راهنما\n- پیشنهاد تصادفی\n- موزیک هنرمند")
-                    send_main_keyboard(chat_id)
-                elif text == "🎵 آهنگ جدید":
-                    success, data = safe_api_call('new_tracks')
-                    if success:
-                        formatted = format_music_results(data, "آهنگ جدید")
-                        send_telegram_message(chat_id, formatted)
-                    else:
-                        send_telegram_message(chat_id, f"❌ خطا در دریافت آهنگ جدید: {data}")
-                elif text == "⭐pie":
-                    success, data = safe_api_call('top_artists')
-                    if success:
-                        artists = data.get('result', {}).get('artists', [])
-                        msg = "⭐ لیست خواننده‌های محبوب:\n" + "\n".join([f"{i+1}. {a.get('name', 'نامشخص')}" for i, a in enumerate(artists)])
-                        send_telegram_message(chat_id, msg)
-                    else:
-                        send_telegram_message(chat_id, f"❌ خطا در دریافت خواننده‌های محبوب: {data}")
-                elif text == "🎶 پلی‌لیست ویژه":
-                    success, data = safe_api_call('special_playlist')
-                    if success:
-                        playlist = data.get('result', {}).get('playlist', [])
-                        msg = "🎶 پلی‌لیست ویژه:\n" + "\n".join([f"{i+1}. {p.get('title', 'نامشخص')}" for i, p in enumerate(playlist)])
-                        send_telegram_message(chat_id, msg)
-                    else:
-                        send_telegram_message(chat_id, f"❌ خطا در دریافت پلی‌لیست ویژه: {data}")
-                elif text == "📈 موزیک ترند":
-                    success, data = safe_api_call('trending_tracks')
-                    if success:
-                        formatted = format_music_results(data, "موزیک ترند")
-                        send_telegram_message(chat_id, formatted)
-                    else:
-                        send_telegram_message(chat_id, f"❌ خطا در دریافت موزیک‌های ترند: {data}")
-                elif text == "🚀 پیشنهاد تصادفی":
-                    success, data = safe_api_call('random_track')
-                    if success:
-                        formatted = format_music_results(data, "پیشنهاد تصادفی")
-                        send_telegram_message(chat_id, formatted)
-                    else:
-                        send_telegram_message(chat_id, f"❌ خطا در پیشنهاد موزیک: {data}")
-                elif text == "❓ راهنما":
-                    msg = "📖 راهنما: برای جستجو یا استفاده از گزینه‌ها فقط کافیست دکمه مربوطه را لمس کنید!"
-                    send_telegram_message(chat_id, msg)
-                elif text == "🎤 موزیک هنرمند":
-                    send_telegram_message(chat_id, "نام هنرمند را وارد کنید تا موزیک‌هایش نمایش داده شود.")
-                elif text == "🎧 پخش آهنگ":
-                    send_telegram_message(chat_id, "نام آهنگ را وارد کنید تا پخش شود.")
-                elif text == "⬇️ دانلود آهنگ":
-                    send_telegram_message(chat_id, "نام آهنگ یا خواننده را وارد کنید تا لینک دانلود نمایش داده شود.")
-                elif text == "🔍 جستجو موزیک":
-                    send_telegram_message(chat_id, "نام آهنگ یا خواننده را وارد کنید:")
-                else:
-                    handle_search_command(text, chat_id)
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict):
+        return jsonify({'error': 'Invalid update'}), 400
+    _count_webhook_stat('received')
+    update_id = update.get('update_id')
+    if _is_duplicate_update(update_id):
+        _count_webhook_stat('duplicates')
+        return jsonify({'status': 'duplicate'})
+    admitted, reply = admit_update(update, get_update_slots())
+    if not admitted:
+        _count_webhook_stat('rejected')
+        return jsonify(webhook_reply(reply) if reply else {'status': 'rejected'})
+    delay = inline_debounce(update)
+    if delay:
+        get_delayed_calls().call_later(delay, _enqueue_held_update, update, time.monotonic())
         return jsonify({'status': 'ok'})
-    except Exception as e:
-        logging.error(f"Webhook error: {e}")
-        return jsonify({'error': str(e)}), 500
+    try:
+        get_update_queue().put_nowait((update, time.monotonic()))
+    except queue.Full:
+        # Let Telegram redeliver it later instead of losing the update
+        get_update_slots().leave()
+        _forget_update(update_id)
+        _count_webhook_stat('dropped')
+        logging.error(f"Update queue full, dropping update {update_id}")
+        return jsonify({'error': 'busy'}), 503
+    return jsonify({'status': 'ok'})
+
+# A response body kept in every encoding we serve, with a strong ETag per representation.
+# respond() is framework-neutral so the Flask and aiohttp apps share it.
+class CompressedBody:
+    __slots__ = ('content_type', 'etag', 'variants')
+
+    def __init__(self, body, content_type, min_size=512):
+        self.content_type = content_type
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': body}
+        if len(body) >= min_size:
+            self.variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body)
+
+    def negotiate(self, accept_encoding):
+        accepted = {}
+        for part in (accept_encoding or '').split(','):
+            name, _, params = part.strip().partition(';')
+            quality = 1.0
+            if params.strip().startswith('q='):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return 'identity'
 
-@app.route('/api/search', methods=['POST'])
+    def _etag_for(self, encoding):
+        return self.etag if encoding == 'identity' else f"{self.etag}-{encoding}"
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        tags = {tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(',')}
+        return any(self._etag_for(encoding) in tags for encoding in self.variants)
+
+    def respond(self, if_none_match, accept_encoding, max_age):
+        # Returns (status, headers, body)
+        encoding = self.negotiate(accept_encoding)
+        headers = {
+            'ETag': f'"{self._etag_for(encoding)}"',
+            'Cache-Control': f'public, max-age={max_age}',
+            'Vary': 'Accept-Encoding',
+        }
+        if self.matches(if_none_match):
+            return 304, headers, b''
+        headers['Content-Type'] = self.content_type
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return 200, headers, self.variants[encoding]
+
+def json_asset(payload):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return CompressedBody(body, 'application/json')
+
+def asset_response(asset, max_age):
+    status, headers, body = asset.respond(request.headers.get('If-None-Match'), request.headers.get('Accept-Encoding'), max_age)
+    return app.response_class(body, status=status, headers=headers)
+
+@app.route('/api/search', methods=['GET', 'POST'])
 def api_search():
+    refused = admit_api_search(client_ip(request.remote_addr, request.headers.get('X-Forwarded-For')))
+    if refused:
+        status, error, retry_after = refused
+        return jsonify({'error': error}), status, {'Retry-After': str(retry_after)}
     try:
-        data = request.get_json()
-        query = data.get('query', '').strip()
+        if request.method == 'GET':
+            query = request.args.get('query', '').strip()
+        else:
+            data = request.get_json()
+            query = data.get('query', '').strip()
         if not query:
             return jsonify({'error': 'Query is required'}), 400
         query = normalize_query(query)
@@ -262,27 +2774,59 @@ def api_search():
         if not success:
             logging.error(f"Search failed for query {query}: {api_data}")
             return jsonify({'error': f'Search failed: {api_data}'}), 500
-        return jsonify(api_data)
+        remember_search(query, api_data)
+        return asset_response(search_api_asset(query, api_data), config.API_SEARCH_MAX_AGE)
     except Exception as e:
         logging.error(f"API search error: {e}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        get_api_search_slots().leave()
 
-@app.route('/health')
-def health():
-    return jsonify({
+def search_api_asset(query, api_data):
+    parsed = get_parsed_response(api_data)
+    if has_search_results(api_data):
+        return parsed.search_asset()
+    payload = parsed.search_payload()
+    payload['suggestions'] = get_search_index().suggest(query)
+    return json_asset(payload)
+
+def health_payload():
+    return {
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'port': PORT,
-        'api_base': API_BASE,
-        'access_key': 'set' if ACCESS_KEY else None,
-        'telegram_token': 'set' if TELEGRAM_TOKEN else None,
-        'webhook_url': WEBHOOK_URL
-    })
+        'port': config.PORT,
+        'api_base': config.API_BASE,
+        'access_key': 'set' if config.ACCESS_KEY else None,
+        'telegram_token': 'set' if config.TELEGRAM_TOKEN else None,
+        'webhook_url': config.WEBHOOK_URL,
+        'upstream_pool': get_api_pool_stats(),
+        'api_cache': get_api_cache().stats(),
+        'api_coalescing': _api_flights.stats(),
+        'shared_cache': get_shared_cache().stats() if get_shared_cache() else None,
+        'result_pages': get_result_pages().stats(),
+        'upstream_breaker': get_api_breaker().stats(),
+        'webhook': get_webhook_stats(),
+        'admission': get_admission_stats(),
+        'audio_delivery': get_audio_stats(),
+        'commands': get_command_stats(),
+        'inline': get_inline_stats(),
+        'search_index': get_search_index().stats(),
+        'file_id_cache': get_file_id_cache().stats(),
+        'subscriptions': get_subscriptions().stats(),
+        'logging': get_log_stats(),
+        'startup': startup_stats
+    }
 
-@app.route('/webapp')
-@app.route('/')
-def index():
-    html_template = """
+@app.route('/health')
+def health():
+    return jsonify(health_payload())
+
+@app.route('/metrics')
+def metrics():
+    refresh_stat_gauges(force=True)
+    return metrics_body(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+WEBAPP_HTML = """
 <!DOCTYPE html>
 <html lang="fa" dir="rtl">
 <head>
@@ -504,13 +3048,7 @@ def index():
             resultsDiv.style.display = 'block';
             resultsDiv.innerHTML = '<div class="loading">در حال جستجو...</div>';
 
-            fetch('/api/search', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({query: query})
-            })
+            fetch('/api/search?query=' + encodeURIComponent(query))
             .then(response => response.json())
             .then(data => {
                 displayResults(data, query);
@@ -532,54 +3070,124 @@ def index():
         function displayResults(data, query) {
             const resultsDiv = document.getElementById('results');
             
-            if (!data.ok || !data.result || !data.result.search_result) {
-                let suggestions = '';
-                if (query.toLowerCase().includes('shadmehr') || query.includes('شادمهر')) {
-                    suggestions = '<div><button class="suggestion-btn" onclick="document.getElementById(\'searchInput\').value=\'Shadmehr Aghili\'; searchMusic();">منظورتان Shadmehr Aghili است؟</button></div>';
-                }
-                resultsDiv.innerHTML = `
-                    <div class="error-message">
-                        ❌ هیچ نتیجه‌ای برای "${query}" پیدا نشد.
-                        <br><br>
- every time I search for something, it returns "نامشخص" (unknown). Here's how I addressed this:
-
-1. **Improved API Handling**: Enhanced the `safe_api_call` function to log the full API response and check for valid JSON structure, ensuring better error reporting.
-2. **Robust Result Formatting**: Updated `format_music_results` to handle cases where the API response is missing expected keys or has unexpected data types, preventing "نامشخص" for malformed responses.
-3. **Logging**: Added detailed logging for API calls, responses, and Telegram interactions to help diagnose issues. Check the logs on Render.com for API response details to verify if the API is returning valid data.
-4. **Telegram Bot Library**: Switched to `pyTelegramBotAPI` for Telegram interactions, which is more reliable than raw `requests` calls.
-5. **Environment Validation**: Added checks for required environment variables (`TELEGRAM_TOKEN`, `ACCESS_KEY`) to fail early with clear errors if they are unset.
-6. **Webapp Routing**: Ensured the `/webapp` route is correctly defined and accessible. The 404 error in the logs suggests a potential issue with how Telegram accesses the web app. Verify that the webhook is correctly set up via `https://api.telegram.org/bot<TELEGRAM_TOKEN>/setWebhook?url=<WEBHOOK_URL>`.
-
-### Next Steps
-1. **Check Logs**: Access the logs on Render.com (via the dashboard or CLI) to inspect the API responses. Look for the `API call` log entries to see the exact response from `https://api.ineo-team.ir/rj.php`. If the response is empty or malformed, the issue may be with the API itself (e.g., invalid `ACCESS_KEY` or query issues).
-2. **Verify Environment Variables**: Ensure `TELEGRAM_TOKEN` and `ACCESS_KEY` are correctly set in Render.com's environment settings (Dashboard > Environment).
-3. **Test API Directly**: Use a tool like Postman to send a test request to `https://api.ineo-team.ir/rj.php` with your `ACCESS_KEY` and a sample query (e.g., `action=search&query=Shadmehr Aghili`). Check if the response contains valid `musics` and `videos` data.
-4. **Webhook Setup**: Confirm the webhook is set correctly by running:
-   ```bash
-   curl -X POST https://api.telegram.org/bot<TELEGRAM_TOKEN>/setWebhook?url=https://behimelobot.onrender.com/webhook
-   ```
-   Replace `<TELEGRAM_TOKEN>` with your bot token.
-5. **Test Webapp**: Access `https://behimelobot.onrender.com/webapp` directly in a browser to verify it loads correctly. If it still returns 404, check Render.com's routing configuration or contact their support.
-
-### Notes
-- The `requirements.txt` includes both `pyTelegramBotAPI` and `telebot`, but only `pyTelegramBotAPI` is used in the updated code. You can remove `telebot==0.0.5` from `requirements.txt` to reduce dependencies:
-  ```text
-  pyTelegramBotAPI==4.16.1
-  requests==2.31.0
-  urllib3==1.26.18
-  gunicorn==21.2.0
-  flask==3.0.0
-  werkzeug==3.0.1
-  ```
-- If the API consistently returns empty or invalid results, contact the API provider (ineo-team.ir) to verify your `ACCESS_KEY` and their API status.
-- The updated code includes a footer change to credit xAI instead of Anthropic AI, per your context.
-
-### Debugging the "نامشخص" Issue
-The "نامشخص" result likely stems from the API returning an empty or unexpected response. The enhanced logging will help identify whether:
-- The API request is failing (e.g., HTTP 403/500 errors).
-- The API response is valid but lacks `musics` or `videos` keys.
-- The `ACCESS_KEY` is invalid or expired.
-
-Check the Render.com logs for `API call` entries. If the API response is empty or malformed, test the API directly (as described above) and consider reaching out to the API provider for support.
-
-If you need further assistance, share the API response logs or any specific error messages from Render.com, and I can help refine the solution!
+            if (!data.ok || !data.tracks) {
+                showNoResults(resultsDiv, data, query);
+                return;
+            }
+
+            let html = '';
+
+            data.tracks.forEach(track => {
+                html += `
+                    <div class="result-item">
+                        <h3>🎵 ${escapeHtml(track.title || 'نامشخص')}</h3>
+                        <p>👤 آرتیست: ${escapeHtml(track.artist || '')}</p>
+                        ${track.audio_url ? `<audio class="audio-player" controls src="${escapeHtml(track.audio_url)}"></audio>` : ''}
+                        ${track.share_link ? `<a class="download-btn" href="${escapeHtml(track.share_link)}" target="_blank">⬇️ دانلود</a>` : ''}
+                    </div>`;
+            });
+
+            (data.videos || []).forEach(video => {
+                html += `
+                    <div class="result-item">
+                        <h3>🎬 ${escapeHtml(video.title || 'نامشخص')}</h3>
+                        <p>👤 آرتیست: ${escapeHtml(video.artist || '')}</p>
+                        ${video.share_link ? `<a class="download-btn" href="${escapeHtml(video.share_link)}" target="_blank">⬇️ دانلود</a>` : ''}
+                    </div>`;
+            });
+
+            if (!html) {
+                showNoResults(resultsDiv, data, query);
+                return;
+            }
+            resultsDiv.innerHTML = html;
+        }
+
+        function escapeHtml(text) {
+            return String(text).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+        }
+
+        function showNoResults(resultsDiv, data, query) {
+            const suggestions = (data.suggestions || []).map(name =>
+                `<div><button class="suggestion-btn" data-query="${escapeHtml(name)}">منظورتان ${escapeHtml(name)} است؟</button></div>`
+            ).join('');
+            resultsDiv.innerHTML = `
+                <div class="error-message">
+                    ❌ هیچ نتیجه‌ای برای "${escapeHtml(query)}" پیدا نشد.
+                    <br><br>
+                    ${suggestions}
+                </div>`;
+            resultsDiv.querySelectorAll('.suggestion-btn').forEach(button => {
+                button.addEventListener('click', () => {
+                    document.getElementById('searchInput').value = button.dataset.query;
+                    searchMusic();
+                });
+            });
+        }
+
+        document.getElementById('searchInput').addEventListener('keypress', function(e) {
+            if (e.key === 'Enter') {
+                searchMusic();
+            }
+        });
+    </script>
+</body>
+</html>
+"""
+
+# The page has no template variables, so it is built and compressed once at startup
+_webapp_asset = None
+_webapp_asset_lock = threading.Lock()
+
+def get_webapp_asset():
+    # Brotli at quality 11 takes tens of milliseconds, so build it once, ideally before workers fork
+    global _webapp_asset
+    if _webapp_asset is None:
+        with _webapp_asset_lock:
+            if _webapp_asset is None:
+                _webapp_asset = CompressedBody(WEBAPP_HTML.encode('utf-8'), 'text/html; charset=utf-8')
+    return _webapp_asset
+
+@app.route('/webapp')
+@app.route('/')
+def index():
+    return asset_response(get_webapp_asset(), config.WEBAPP_MAX_AGE)
+
+# Read-only state is built here, once. Under `gunicorn --preload` that happens in the master, and
+# workers share it copy-on-write; per-process clients (HTTP session, bot, queues, SQLite) are still
+# created lazily inside each worker.
+startup_stats = {}
+
+def warm_up():
+    if startup_stats:
+        return
+    started = time.perf_counter()
+    config.load()
+    configure_logging()
+    config.require('TELEGRAM_TOKEN', 'ACCESS_KEY')
+    loaded = time.perf_counter()
+    get_webapp_asset()
+    ready = time.perf_counter()
+    startup_stats.update({
+        'import_seconds': round(_imported - _import_started, 4),
+        'config_seconds': round(loaded - started, 4),
+        'webapp_asset_seconds': round(ready - loaded, 4),
+        'total_seconds': round(ready - _import_started, 4),
+        'budget_seconds': config.STARTUP_BUDGET,
+        'pid': os.getpid(),
+    })
+    startup_stats['within_budget'] = startup_stats['total_seconds'] <= config.STARTUP_BUDGET
+    if startup_stats['within_budget']:
+        logging.info(f"Startup took {startup_stats['total_seconds']:.3f}s: {startup_stats}")
+    else:
+        logging.warning(f"Startup took {startup_stats['total_seconds']:.3f}s, over the {config.STARTUP_BUDGET}s budget: {startup_stats}")
+
+def create_app():
+    # gunicorn 'behimelobot_render:create_app()'
+    warm_up()
+    return app
+
+_imported = time.perf_counter()
+
+if __name__ == '__main__':
+    create_app().run(host='0.0.0.0', port=config.PORT)
@@ -0,0 +1,31 @@
+import os
+import shutil
+
+# Picked up automatically by gunicorn started from the repo root. With PROMETHEUS_MULTIPROC_DIR set,
+# workers share metrics through files in that directory; start clean and drop dead workers' gauges.
+
+# Import the app and run create_app() once in the master; workers fork with config, routes and the
+# compressed webapp already built instead of each paying for them
+preload_app = True
+
+def on_starting(server):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+def post_fork(server, worker):
+    # Background jobs need their threads in a worker; the notifier's lock file and the prefetch lease
+    # keep each to one of them
+    import behimelobot_render as core
+    if core.config.NOTIFY_ENABLED:
+        import behimelobot_notify
+        behimelobot_notify.start_in_background()
+    if core.config.PREFETCH_ENABLED:
+        import behimelobot_prefetch
+        behimelobot_prefetch.start_in_background()
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)